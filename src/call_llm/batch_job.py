@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import time
+from src.utils import prepare_file
+
+logger = logging.getLogger(__name__)
+
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchJob:
+    """
+    Run chat completions offline through the OpenAI Batch API with the client of a `GPT` instance.
+    Request files `requests_XXXX.jsonl`, their results `requests_XXXX.output.jsonl` and `state.json`
+    (batch id of each request file) live in `batch_dir`, so an interrupted job resumes polling instead of
+    resubmitting. Result files produced elsewhere (e.g. `vllm run_batch`) can be dropped next to the requests.
+    """
+
+    def __init__(self, gpt, batch_dir: str, max_requests: int = 50000, poll_interval: float = 60) -> None:
+        self.gpt = gpt
+        self.batch_dir = batch_dir
+        self.max_requests = max_requests
+        self.poll_interval = poll_interval
+        self.state_path = os.path.join(batch_dir, "state.json")
+        self.state = {}
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    @property
+    def url(self):
+        # Azure deployments expose the batch endpoint without the version prefix
+        return "/chat/completions" if self.gpt.api_type == "azure" else "/v1/chat/completions"
+
+    def _save_state(self):
+        prepare_file(self.state_path)
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+
+    @staticmethod
+    def output_path(request_path):
+        return request_path[: -len(".jsonl")] + ".output.jsonl"
+
+    def _request_ids(self, path) -> set[str]:
+        with open(path) as f:
+            return set(json.loads(line)["custom_id"] for line in f if line.strip())
+
+    def prepare(self, requests: list[tuple], sampling_params: dict) -> list[str]:
+        """
+        Write (key, messages) requests to batch files once, `key` must be json serializable.
+        Request files kept from a previous run are reused, only requests in none of them are written.
+        """
+        written = set()
+        for path in self.state:
+            written |= self._request_ids(path)
+        if written:
+            logger.info(f"Reuse {len(self.state)} request files in `{self.batch_dir}`")
+        requests = [(key, messages) for key, messages in requests if json.dumps(key) not in written]
+        # numbered after the kept files, never over them
+        first_idx = max([int(os.path.basename(p)[len("requests_") : -len(".jsonl")]) for p in self.state], default=-1) + 1
+        for start_idx in range(0, len(requests), self.max_requests):
+            path = os.path.join(self.batch_dir, f"requests_{first_idx + start_idx // self.max_requests:04d}.jsonl")
+            prepare_file(path)
+            with open(path, "w") as f:
+                for key, messages in requests[start_idx : start_idx + self.max_requests]:
+                    obj = {
+                        "custom_id": json.dumps(key),
+                        "method": "POST",
+                        "url": self.url,
+                        "body": {"model": self.gpt.model_name, "messages": messages, **sampling_params},
+                    }
+                    f.write(json.dumps(obj) + "\n")
+            self.state[path] = None
+        self._save_state()
+        if requests:
+            logger.info(f"Wrote {len(requests)} new requests in `{self.batch_dir}`, {len(self.state)} files in total")
+        return list(self.state)
+
+    def submit(self):
+        for path, batch_id in self.state.items():
+            if batch_id is not None or os.path.isfile(self.output_path(path)):
+                continue
+            with open(path, "rb") as f:
+                input_file = self.gpt.client.files.create(file=f, purpose="batch")
+            batch = self.gpt.client.batches.create(
+                input_file_id=input_file.id, endpoint=self.url, completion_window="24h"
+            )
+            self.state[path] = batch.id
+            self._save_state()
+            logger.info(f"Submitted `{path}` as batch {batch.id}")
+
+    def wait(self):
+        """Poll until every batch is final and download its results"""
+        pending = {p: b for p, b in self.state.items() if b is not None and not os.path.isfile(self.output_path(p))}
+        while pending:
+            for path, batch_id in list(pending.items()):
+                batch = self.gpt.client.batches.retrieve(batch_id)
+                if batch.status not in FINAL_STATUSES:
+                    continue
+                logger.info(f"Batch {batch_id} {batch.status}: {batch.request_counts}")
+                # partially completed batches still have an output file, failed requests are retried next run
+                if batch.output_file_id:
+                    content = self.gpt.client.files.content(batch.output_file_id)
+                    with open(self.output_path(path), "w") as f:
+                        f.write(content.text)
+                if batch.status != "completed":
+                    self.state[path] = None
+                    self._save_state()
+                del pending[path]
+            if pending:
+                time.sleep(self.poll_interval)
+
+    def iter_results(self):
+        """Yield (key, response) of every successful request in the result files"""
+        n_failed = 0
+        for path in self.state:
+            output_path = self.output_path(path)
+            if not os.path.isfile(output_path):
+                continue
+            with open(output_path) as f:
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    obj = json.loads(line)
+                    response = obj.get("response") or {}
+                    if obj.get("error") or response.get("status_code") != 200:
+                        n_failed += 1
+                        continue
+                    choices = response["body"]["choices"]
+                    content = choices[0]["message"]["content"] if choices else ""
+                    yield json.loads(obj["custom_id"]), (content or "").strip()
+        if n_failed > 0:
+            logger.warning(f"{n_failed} batch requests failed, rerun to retry them")
+
+    def cleanup(self):
+        """
+        Forget the request files whose results were downloaded and ingested. Batches not submitted or still
+        running keep their files and batch id, to be polled by a later `run`. Failed requests of an ingested
+        batch are written again by the next `prepare`.
+        """
+        for path in list(self.state):
+            if not os.path.isfile(self.output_path(path)):
+                continue
+            os.remove(path)
+            os.remove(self.output_path(path))
+            del self.state[path]
+        if self.state:
+            self._save_state()
+            logger.info(f"Kept {len(self.state)} request files without results in `{self.batch_dir}`")
+        elif os.path.isfile(self.state_path):
+            os.remove(self.state_path)
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from src.utils import prepare_file
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    On-disk LLM response cache keyed by a hash of (model, messages, sampling params).
+    When `max_size_mb` > 0, least recently used responses are evicted once the stored text exceeds it.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 0, evict_every: int = 1000) -> None:
+        prepare_file(path)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.n_sets = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses(accessed_at)")
+
+    @staticmethod
+    def make_key(model_name: str, messages, sampling_params) -> str:
+        # vLLM SamplingParams is not json serializable, its repr lists every field
+        if not isinstance(sampling_params, dict):
+            sampling_params = repr(sampling_params)
+        payload = json.dumps(
+            {"model": model_name, "messages": messages, "sampling_params": sampling_params},
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        # empty responses mean the request failed, retry them next time
+        if not response:
+            return
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), time.time()),
+            )
+            self.n_sets += 1
+            if self.max_size > 0 and self.n_sets % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        excess = total - self.max_size
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        logger.info(f"Evicted {len(keys)} responses from `{self.path}`")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+    def close(self):
+        logger.info(f"Response cache stats: {self.stats()}")
+        with self.lock:
+            if self.max_size > 0:
+                self._evict()
+            self.conn.close()
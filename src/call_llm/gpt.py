@@ -1,7 +1,15 @@
+import asyncio
 import logging
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from types import SimpleNamespace
 import yaml
-from openai import AzureOpenAI, OpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI, RateLimitError
+from src.call_llm.hedge import LatencyTracker
+from src.call_llm.key_pool import DeploymentPool
+from src.call_llm.retry import CONFIG_ERRORS, Backoff, CircuitBreaker, RetryStats, is_retryable
+from src.call_llm.router import EndpointRouter
 
 logger = logging.getLogger(__name__)
 
@@ -13,54 +21,403 @@ class GPT:
         api_type="",
         wait_time: float = 0.0,
         max_retry: int = 5,
+        max_wait_time: float = 60.0,
+        breaker_window: float = 60.0,
+        breaker_min_requests: int = 20,
+        breaker_error_rate: float = 0.5,
+        breaker_cooldown: float = 30.0,
+        eject_time: float = 30.0,
+        hedge_quantile: float = 0.0,
+        hedge_min_delay: float = 1.0,
+        hedge_max_ratio: float = 0.1,
+        cache=None,
         **kwargs,
     ) -> None:
-        if api_type == "openai":
-            self.client = OpenAI(api_key=kwargs["api_key"])
+        # retries are handled below, not by the SDK
+        self.router = None
+        if api_type in ("openai", "azure") and kwargs.get("deployments"):
+            # several keys/deployments of the same model, their rate limits add up
+            self.router = DeploymentPool.from_config(api_type, kwargs["deployments"], eject_time=eject_time)
+            self.client = self.router.endpoints[0].client
+            self.async_client = self.router.endpoints[0].async_client
+        elif api_type == "openai":
+            self.client = OpenAI(api_key=kwargs["api_key"], max_retries=0)
+            self.async_client = AsyncOpenAI(api_key=kwargs["api_key"], max_retries=0)
         elif api_type == "azure":
             self.client = AzureOpenAI(
                 api_version=kwargs["api_version"],
                 api_key=kwargs["api_key"],
                 azure_endpoint=kwargs["endpoint"],
+                max_retries=0,
             )
+            self.async_client = AsyncAzureOpenAI(
+                api_version=kwargs["api_version"],
+                api_key=kwargs["api_key"],
+                azure_endpoint=kwargs["endpoint"],
+                max_retries=0,
+            )
+        elif api_type == "local" and kwargs.get("endpoints"):
+            # several servers of the same model, each request goes to the least loaded one
+            self.router = EndpointRouter.from_urls(kwargs["endpoints"], kwargs["api_key"], eject_time=eject_time)
+            self.client = self.router.endpoints[0].client
+            self.async_client = self.router.endpoints[0].async_client
         elif api_type == "local":
             self.client = OpenAI(
-                base_url=kwargs["endpoint"], api_key=kwargs['api_key']
+                base_url=kwargs["endpoint"], api_key=kwargs['api_key'], max_retries=0
+            )
+            self.async_client = AsyncOpenAI(
+                base_url=kwargs["endpoint"], api_key=kwargs['api_key'], max_retries=0
             )
         self.model_name = model_name
+        self.api_type = api_type
         self.wait_time = wait_time
         self.max_retry = max_retry
+        self.cache = cache
+        # `wait_time` is the base of the exponential backoff
+        self.backoff = Backoff(base_delay=wait_time if wait_time > 0 else 1.0, max_delay=max_wait_time)
+        # shared by every thread/coroutine using this client
+        self.breaker = CircuitBreaker(
+            window=breaker_window,
+            min_requests=breaker_min_requests,
+            error_rate=breaker_error_rate,
+            cooldown=breaker_cooldown,
+        )
+        self.stats = RetryStats()
+        # a request still running after the `hedge_quantile` latency is duplicated, 0 disables hedging
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        # when the whole endpoint slows down, hedging everything would only double its load
+        self.hedge_max_ratio = hedge_max_ratio
+        self.latency = LatencyTracker()
+        self.hedge_executor = ThreadPoolExecutor(max_workers=256) if hedge_quantile > 0 else None
+
+    def get_stats(self) -> dict:
+        stats = {**self.stats.as_dict(), "circuit_opens": self.breaker.n_opens}
+        if self.router is not None:
+            stats["endpoints"] = self.router.stats()
+        return stats
+
+    @contextmanager
+    def _route(self, messages, sampling_params, is_async: bool = False):
+        """
+        Yield (client, model name, delay) to send one request with, picked by the router when there are
+        several endpoints or deployments. The delay keeps the request within their rate limits.
+        """
+        if self.router is None:
+            yield self.async_client if is_async else self.client, self.model_name, 0.0
+            return
+        # rate limits count the prompt and the whole completion budget
+        n_tokens = sum(len(m["content"]) for m in messages) // 4 + sampling_params.get("max_tokens", 0)
+        with self.router.use(n_tokens) as (endpoint, delay):
+            client = endpoint.async_client if is_async else endpoint.client
+            yield client, endpoint.model_name or self.model_name, delay
+
+    def _hedge_delay(self) -> float | None:
+        if self.hedge_quantile <= 0:
+            return None
+        delay = self.latency.quantile(self.hedge_quantile)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    def _hedge_allowed(self) -> bool:
+        stats = self.stats.as_dict()
+        return stats.get("hedged", 0) < self.hedge_max_ratio * stats.get("requests", 0)
+
+    def _count_usage(self, res, extra: bool = False):
+        if res.usage is None:
+            return
+        self.stats.add("prompt_tokens", res.usage.prompt_tokens)
+        self.stats.add("completion_tokens", res.usage.completion_tokens)
+        if extra:
+            self.stats.add("hedge_extra_tokens", res.usage.total_tokens)
+
+    def _count_loser(self, future):
+        # a thread cannot be interrupted, the duplicate runs to completion and is billed in full
+        if not future.cancelled() and future.exception() is None:
+            self._count_usage(future.result(), extra=True)
+
+    def _create_once(self, messages, sampling_params, guard=None):
+        with self._route(messages, sampling_params) as (client, model_name, delay):
+            time.sleep(delay)
+            start = time.monotonic()
+            if guard is None:
+                res = client.chat.completions.create(model=model_name, messages=messages, **sampling_params)
+            else:
+                stream = client.chat.completions.create(
+                    model=model_name, messages=messages, stream=True, stream_options={"include_usage": True}, **sampling_params
+                )
+                res = self._consume_stream(stream, guard())
+        self.latency.add(time.monotonic() - start)
+        return res
+
+    async def _acreate_once(self, messages, sampling_params, guard=None):
+        with self._route(messages, sampling_params, is_async=True) as (client, model_name, delay):
+            await asyncio.sleep(delay)
+            start = time.monotonic()
+            if guard is None:
+                res = await client.chat.completions.create(model=model_name, messages=messages, **sampling_params)
+            else:
+                stream = await client.chat.completions.create(
+                    model=model_name, messages=messages, stream=True, stream_options={"include_usage": True}, **sampling_params
+                )
+                res = await self._aconsume_stream(stream, guard())
+        self.latency.add(time.monotonic() - start)
+        return res
+
+    def _stream_result(self, guard, finish_reason, usage):
+        """Completion-like result of a consumed stream, `finish_reason` is "aborted" when the guard stopped it"""
+        if finish_reason == "aborted":
+            self.stats.add("stream_aborted")
+        message = SimpleNamespace(content=guard.result())
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason=finish_reason)], usage=usage)
+
+    def _consume_stream(self, stream, guard):
+        finish_reason, usage = None, None
+        for chunk in stream:
+            usage = chunk.usage or usage
+            if not chunk.choices:
+                continue
+            if not guard.feed(chunk.choices[0].delta.content or ""):
+                # closing the connection makes the server abort the generation
+                stream.close()
+                finish_reason = "aborted"
+                break
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+        return self._stream_result(guard, finish_reason, usage)
+
+    async def _aconsume_stream(self, stream, guard):
+        finish_reason, usage = None, None
+        async for chunk in stream:
+            usage = chunk.usage or usage
+            if not chunk.choices:
+                continue
+            if not guard.feed(chunk.choices[0].delta.content or ""):
+                await stream.close()
+                finish_reason = "aborted"
+                break
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+        return self._stream_result(guard, finish_reason, usage)
+
+    def _create(self, messages, sampling_params, guard=None):
+        """One attempt, duplicated when slower than the hedge delay, the first successful answer wins"""
+        delay = self._hedge_delay()
+        if delay is None:
+            res = self._create_once(messages, sampling_params, guard)
+            self._count_usage(res)
+            return res
+        primary = self.hedge_executor.submit(self._create_once, messages, sampling_params, guard)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._hedge_allowed():
+            res = primary.result()
+            self._count_usage(res)
+            return res
+        self.stats.add("hedged")
+        backup = self.hedge_executor.submit(self._create_once, messages, sampling_params, guard)
+        pending = {primary, backup}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((f for f in done if f.exception() is None), None)
+            if winner is not None or not pending:
+                break
+        if winner is None:
+            raise next(iter(done)).exception()
+        if winner is backup:
+            self.stats.add("hedge_wins")
+        for future in {primary, backup} - {winner}:
+            future.add_done_callback(self._count_loser)
+        res = winner.result()
+        self._count_usage(res)
+        return res
+
+    async def _acreate(self, messages, sampling_params, guard=None):
+        """Async `_create`, the slower request is cancelled"""
+        delay = self._hedge_delay()
+        if delay is None:
+            res = await self._acreate_once(messages, sampling_params, guard)
+            self._count_usage(res)
+            return res
+        primary = asyncio.ensure_future(self._acreate_once(messages, sampling_params, guard))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not self._hedge_allowed():
+            res = await primary
+            self._count_usage(res)
+            return res
+        self.stats.add("hedged")
+        backup = asyncio.ensure_future(self._acreate_once(messages, sampling_params, guard))
+        pending = {primary, backup}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # read every exception so none is reported as never retrieved
+                succeeded = [t for t in done if t.exception() is None]
+                winner = succeeded[0] if succeeded else None
+                if winner is not None or not pending:
+                    break
+        finally:
+            # also reached when the caller itself is cancelled
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if winner is None:
+            raise next(iter(done)).exception()
+        if winner is backup:
+            self.stats.add("hedge_wins")
+        res = winner.result()
+        self._count_usage(res)
+        for task in succeeded[1:]:
+            self._count_usage(task.result(), extra=True)
+        # the server drops a cancelled request, its prompt was already processed
+        if pending and res.usage is not None:
+            self.stats.add("hedge_extra_tokens", res.usage.prompt_tokens)
+        return res
+
+    def _handle_error(self, err: Exception, attempt: int) -> float | None:
+        """Return the delay before the next attempt, None to give up on this request"""
+        # the pool disabled the deployment, the others may still serve the request
+        failed_over = isinstance(err, CONFIG_ERRORS) and isinstance(self.router, DeploymentPool) and self.router.any_usable()
+        if isinstance(err, CONFIG_ERRORS) and not failed_over:
+            self.stats.add("fatal")
+            raise err
+        if not failed_over and not is_retryable(err):
+            # a bad request (context length, content filter) says nothing about the health of the endpoint
+            self.stats.add("fatal")
+            logger.error(f"Non-retryable error: {err}")
+            return None
+        # a failing server behind the router is ejected, pause everyone only when none is left
+        if not failed_over and (self.router is None or not self.router.any_healthy()):
+            self.breaker.record(False)
+        if isinstance(err, RateLimitError):
+            self.stats.add("throttled")
+        if attempt + 1 >= self.max_retry:
+            self.stats.add("failed")
+            logger.info("Maximum retry exceeded")
+            return None
+        self.stats.add("retries")
+        if failed_over or (
+            isinstance(err, RateLimitError) and isinstance(self.router, DeploymentPool) and self.router.any_healthy()
+        ):
+            # fail over to a deployment that is not throttled, only a pool tracks throttling, a local router
+            # would send the retry straight back to a throttled server
+            return 0.0
+        delay = self.backoff.delay(attempt, err)
+        logger.warning(f"Retry in {delay:.1f}s after error: {err}")
+        return delay
 
     def generate(
         self,
         messages: list[dict[str, str]],
         sampling_params: dict,
+        retry_max_tokens: int | None = None,
+        guard=None,
+    ):
+        """
+        A response cut at `max_tokens` is generated again with `retry_max_tokens`, if given.
+        With `guard`, a factory of objects with `feed(delta) -> bool` and `result() -> str` such as
+        `parse.ExtractionStreamGuard`, the response is streamed and dropped as soon as `feed` returns False.
+        """
+        if self.cache is None:
+            return self._generate(messages, sampling_params, retry_max_tokens, guard)[0]
+        key = self.cache.make_key(self.model_name, messages, self._cache_params(sampling_params, retry_max_tokens))
+        response = self.cache.get(key)
+        if response is None:
+            response, finish_reason = self._generate(messages, sampling_params, retry_max_tokens, guard)
+            self._cache_set(key, response, finish_reason)
+        return response
+
+    async def agenerate(
+        self,
+        messages: list[dict[str, str]],
+        sampling_params: dict,
+        retry_max_tokens: int | None = None,
+        guard=None,
     ):
-        response = ""
-        cnt = 0
-        while response == "":
+        """Same as `generate` but awaits the async client so many requests can be in flight"""
+        if self.cache is None:
+            return (await self._agenerate(messages, sampling_params, retry_max_tokens, guard))[0]
+        key = self.cache.make_key(self.model_name, messages, self._cache_params(sampling_params, retry_max_tokens))
+        response = self.cache.get(key)
+        if response is None:
+            response, finish_reason = await self._agenerate(messages, sampling_params, retry_max_tokens, guard)
+            self._cache_set(key, response, finish_reason)
+        return response
+
+    def _cache_set(self, key: str, response: str, finish_reason: str | None):
+        # a stream stopped by the guard is cut short, it must not be served for this prompt later, guarded or not
+        if finish_reason != "aborted":
+            self.cache.set(key, response)
+
+    @staticmethod
+    def _cache_params(sampling_params: dict, retry_max_tokens: int | None) -> dict:
+        # the final response is the one of the full budget, so predicted budgets share its cache entry
+        if retry_max_tokens is None:
+            return sampling_params
+        return {**sampling_params, "max_tokens": retry_max_tokens}
+
+    def _is_truncated(self, res, sampling_params: dict, retry_max_tokens: int | None) -> bool:
+        if retry_max_tokens is None or retry_max_tokens <= sampling_params.get("max_tokens", 0):
+            return False
+        if res.choices[0].finish_reason != "length":
+            return False
+        self.stats.add("truncated")
+        if res.usage is not None:
+            self.stats.add("truncated_tokens", res.usage.completion_tokens)
+        return True
+
+    def _generate(
+        self,
+        messages: list[dict[str, str]],
+        sampling_params: dict,
+        retry_max_tokens: int | None = None,
+        guard=None,
+    ) -> tuple[str, str | None]:
+        """Return the response and its finish reason, ("", None) when every attempt failed"""
+        for attempt in range(self.max_retry):
+            time.sleep(self.breaker.wait_time())
+            self.stats.add("requests")
             try:
-                res = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    **sampling_params,
-                )
-                if res.choices:
-                    response = res.choices[0].message.content.strip()
-                    # logger.info(f"Retrieved response from model:{response}")
-                    return response
+                res = self._create(messages, sampling_params, guard)
             except Exception as err:
-                logger.error(f"Unexpected error: {err}")
-                cnt += 1
-                if cnt == self.max_retry:
-                    logger.info("Maximum retry exceeded")
+                delay = self._handle_error(err, attempt)
+                if delay is None:
                     break
-                if self.wait_time > 0:
-                    time.sleep(self.wait_time)
+                time.sleep(delay)
+                continue
+            self.breaker.record(True)
+            if res.choices and self._is_truncated(res, sampling_params, retry_max_tokens):
+                return self._generate(messages, {**sampling_params, "max_tokens": retry_max_tokens}, guard=guard)
+            if res.choices:
+                response = (res.choices[0].message.content or "").strip()
+                # logger.info(f"Retrieved response from model:{response}")
+                return response, res.choices[0].finish_reason
 
-        if response == "":
-            logger.info("Failed to generate text after retries.")
-        return response
+        logger.info("Failed to generate text after retries.")
+        return "", None
+
+    async def _agenerate(
+        self,
+        messages: list[dict[str, str]],
+        sampling_params: dict,
+        retry_max_tokens: int | None = None,
+        guard=None,
+    ) -> tuple[str, str | None]:
+        for attempt in range(self.max_retry):
+            await asyncio.sleep(self.breaker.wait_time())
+            self.stats.add("requests")
+            try:
+                res = await self._acreate(messages, sampling_params, guard)
+            except Exception as err:
+                delay = self._handle_error(err, attempt)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record(True)
+            if res.choices and self._is_truncated(res, sampling_params, retry_max_tokens):
+                return await self._agenerate(messages, {**sampling_params, "max_tokens": retry_max_tokens}, guard=guard)
+            if res.choices:
+                return (res.choices[0].message.content or "").strip(), res.choices[0].finish_reason
+
+        logger.info("Failed to generate text after retries.")
+        return "", None
 
 
 if __name__ == "__main__":
@@ -69,5 +426,5 @@ if __name__ == "__main__":
     model = GPT(**model_config)
     sampling_params = {"max_tokens": 32, "temperature": 1.0, "top_p": 1.0,}
     messages = [{"role": "user", "content": "Hello, who are you?"}]
-    res = model.generate(messages, **sampling_params)
+    res = model.generate(messages, sampling_params)
     print(res)
@@ -0,0 +1,23 @@
+import threading
+from collections import deque
+import numpy as np
+
+
+class LatencyTracker:
+    """Sliding window of request latencies, gives the delay after which a request is hedged"""
+
+    def __init__(self, window: int = 1000, min_samples: int = 20) -> None:
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def quantile(self, q: float) -> float | None:
+        """None until enough requests completed to trust the estimate"""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.quantile(np.fromiter(self.latencies, dtype=np.float64), q))
@@ -0,0 +1,106 @@
+import logging
+import math
+import time
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI, RateLimitError
+from src.call_llm.rate_limiter import TokenBucket
+from src.call_llm.retry import CONFIG_ERRORS, get_retry_after
+from src.call_llm.router import Endpoint, EndpointRouter
+
+logger = logging.getLogger(__name__)
+
+
+class Deployment(Endpoint):
+    """An API key or Azure deployment with its own requests/tokens per minute quota"""
+
+    def __init__(self, api_type: str, api_key: str, endpoint=None, api_version=None, model_name=None, rpm=0, tpm=0) -> None:
+        if api_type == "azure":
+            kwargs = {"api_key": api_key, "azure_endpoint": endpoint, "api_version": api_version, "max_retries": 0}
+            client, async_client = AzureOpenAI(**kwargs), AsyncAzureOpenAI(**kwargs)
+        else:
+            kwargs = {"api_key": api_key, "base_url": endpoint, "max_retries": 0}
+            client, async_client = OpenAI(**kwargs), AsyncOpenAI(**kwargs)
+        # the key itself must never end up in logs or stats
+        name = f"{endpoint or api_type}/{model_name or ''}#{api_key[-4:]}"
+        super().__init__(name, client, async_client, model_name=model_name)
+        # quotas are enforced over ~10s windows, so bursts are limited to 10s worth of the minute quota
+        self.rpm_bucket = TokenBucket(rate=rpm / 60, capacity=rpm / 6) if rpm > 0 else None
+        self.tpm_bucket = TokenBucket(rate=tpm / 60, capacity=tpm / 6) if tpm > 0 else None
+        self.throttled_until = 0.0
+        self.n_throttled = 0
+        # a revoked key or a wrong deployment name never recovers
+        self.disabled = False
+
+    def wait_time(self, n_tokens: int) -> float:
+        wait = max(0.0, self.throttled_until - time.monotonic())
+        if self.rpm_bucket is not None:
+            wait = max(wait, self.rpm_bucket.wait_time(1))
+        if self.tpm_bucket is not None:
+            wait = max(wait, self.tpm_bucket.wait_time(n_tokens))
+        return wait
+
+    def reserve(self, n_tokens: int) -> float:
+        wait = max(0.0, self.throttled_until - time.monotonic())
+        if self.rpm_bucket is not None:
+            wait = max(wait, self.rpm_bucket.reserve(1))
+        if self.tpm_bucket is not None:
+            wait = max(wait, self.tpm_bucket.reserve(n_tokens))
+        return wait
+
+
+class DeploymentPool(EndpointRouter):
+    """
+    Spread requests of one model over several keys/deployments so their quotas add up.
+    Each request goes to the deployment able to send it soonest under its `rpm`/`tpm` token buckets,
+    a throttled deployment is skipped until its `Retry-After` (or `throttle_time`) has passed.
+    Connection failures eject a deployment as in `EndpointRouter`, authentication, permission and not-found
+    errors disable it for the rest of the run.
+    """
+
+    def __init__(self, endpoints: list[Deployment], throttle_time: float = 10.0, **kwargs) -> None:
+        self.throttle_time = throttle_time
+        super().__init__(endpoints, **kwargs)
+
+    @classmethod
+    def from_config(cls, api_type: str, deployments: list[dict], **kwargs) -> "DeploymentPool":
+        return cls([Deployment(api_type, **deployment) for deployment in deployments], **kwargs)
+
+    def acquire(self, n_tokens: int = 0) -> tuple[Deployment, float]:
+        with self.lock:
+            usable = [e for e in self.endpoints if not e.disabled] or self.endpoints
+            candidates = [e for e in usable if e.healthy] or usable
+            endpoint = min(candidates, key=lambda e: (e.wait_time(n_tokens), e.outstanding))
+            delay = endpoint.reserve(n_tokens)
+            endpoint.outstanding += 1
+            endpoint.n_requests += 1
+            return endpoint, delay
+
+    def release(self, endpoint: Deployment, err: Exception | None = None):
+        if isinstance(err, RateLimitError):
+            retry_after = get_retry_after(err)
+            with self.lock:
+                endpoint.throttled_until = time.monotonic() + (retry_after or self.throttle_time)
+                endpoint.n_throttled += 1
+        elif isinstance(err, CONFIG_ERRORS):
+            with self.lock:
+                if not endpoint.disabled:
+                    endpoint.disabled = True
+                    # never probed again by the health check
+                    endpoint.ejected_until = math.inf
+                    logger.error(f"Disable deployment {endpoint.base_url}: {err}")
+        super().release(endpoint, err)
+
+    def any_healthy(self) -> bool:
+        """Whether some deployment can take a request right away"""
+        now = time.monotonic()
+        return any(e.healthy and e.throttled_until <= now for e in self.endpoints)
+
+    def any_usable(self) -> bool:
+        """Whether some deployment is not disabled, even if ejected or throttled for now"""
+        return any(not e.disabled for e in self.endpoints)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        for e in self.endpoints:
+            stats[e.base_url]["throttled"] = e.n_throttled
+            stats[e.base_url]["disabled"] = e.disabled
+        return stats
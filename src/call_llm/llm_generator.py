@@ -2,9 +2,14 @@ from typing import List, Dict, Text
 import gc
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
+from src.call_llm.scheduler import build_batches
 
 class LlmGenerator(object):
-    def __init__(self, model_path, dtype=None):
+    def __init__(self, model_path, dtype=None, cache=None, max_batch_tokens=0):
+        self.model_path = model_path
+        self.cache = cache
+        # 0 generates all input texts in one padded batch
+        self.max_batch_tokens = max_batch_tokens
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side='left')
         self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
         self.model = AutoModelForCausalLM.from_pretrained(
@@ -19,8 +24,37 @@ class LlmGenerator(object):
             self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
         ]
 
-    def generate(self, input_texts: List[Text], sampling_params): 
-        encoded_input = self.tokenizer(input_texts, padding=True, return_tensors='pt')
+    def generate(self, input_texts: List[Text], sampling_params):
+        if self.cache is None:
+            return self._generate(input_texts, sampling_params)
+        keys = [self.cache.make_key(self.model_path, text, sampling_params) for text in input_texts]
+        responses = [self.cache.get(key) for key in keys]
+        # only generate the texts that are not cached
+        indices = [i for i, r in enumerate(responses) if r is None]
+        if indices:
+            outputs = self._generate([input_texts[i] for i in indices], sampling_params)
+            for i, response in zip(indices, outputs):
+                responses[i] = response
+                self.cache.set(keys[i], response)
+        return responses
+
+    def _generate(self, input_texts: List[Text], sampling_params):
+        # tokenize once, then bucket by length so short prompts are not padded to the longest one
+        encoded_inputs = self.tokenizer(input_texts)['input_ids']
+        if self.max_batch_tokens > 0:
+            lengths = [len(ids) for ids in encoded_inputs]
+            batches = build_batches(lengths, self.max_batch_tokens, padded=True)
+        else:
+            batches = [list(range(len(encoded_inputs)))]
+        responses = [None] * len(input_texts)
+        for batch in batches:
+            outputs = self._generate_batch([encoded_inputs[i] for i in batch], sampling_params)
+            for i, response in zip(batch, outputs):
+                responses[i] = response
+        return responses
+
+    def _generate_batch(self, encoded_inputs: List[List[int]], sampling_params):
+        encoded_input = self.tokenizer.pad({'input_ids': encoded_inputs}, padding=True, return_tensors='pt')
         input_ids = encoded_input['input_ids'].to(self.model.device)
         attention_mask = encoded_input['attention_mask'].to(self.model.device)
         self.model.eval()    
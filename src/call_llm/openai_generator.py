@@ -1,29 +1,39 @@
 from typing import List, Dict, Text
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AzureOpenAI, RateLimitError
 import time
+from src.call_llm.retry import CONFIG_ERRORS, Backoff, CircuitBreaker, RetryStats, is_retryable
 
 class OpenAIGenerator:
-    def __init__(self, model_name, api_key, api_version=None, endpoint = None):
+    def __init__(self, model_name, api_key, api_version=None, endpoint = None, max_retry=10, max_wait_time=60.0):
         self.model_name = model_name
+        self.max_retry = max_retry
+        self.max_wait_time = max_wait_time
+        self.breaker = CircuitBreaker()
+        self.stats = RetryStats()
         if api_version:
             self.client = AzureOpenAI(
                 api_key = api_key,
                 azure_endpoint = endpoint,
-                api_version = api_version
+                api_version = api_version,
+                max_retries = 0
             )
         else:
             self.client = OpenAI(
                 api_key=api_key,
+                max_retries=0,
             )
 
     def generate(self, messages: List[Dict[Text, Text]], max_tokens=128, time_sleep=1, **kwargs) -> str:
         """
         :param messages: List of messages to send
         :param max_tokens: The maximum number of tokens to generate.
-        :return: The generated text.
+        :param time_sleep: Base delay of the exponential backoff between retries.
+        :return: The generated text, empty if every retry failed or the request was rejected.
         """
-        response = ''
-        while not response:
+        backoff = Backoff(base_delay=time_sleep, max_delay=self.max_wait_time)
+        for attempt in range(self.max_retry):
+            time.sleep(self.breaker.wait_time())
+            self.stats.add("requests")
             try:
                 response = self.client.chat.completions.create(
                     model=self.model_name,
@@ -32,7 +42,26 @@ class OpenAIGenerator:
                     **kwargs
                 )
             except Exception as e:
+                if isinstance(e, CONFIG_ERRORS):
+                    self.stats.add("fatal")
+                    raise e
+                if not is_retryable(e):
+                    # like `GPT`, a bad request (e.g. content filter) gives up on this prompt only
+                    self.stats.add("fatal")
+                    print(f"Non-retryable error: {e}")
+                    return ""
+                # only transient errors count toward the error rate
+                self.breaker.record(False)
+                if isinstance(e, RateLimitError):
+                    self.stats.add("throttled")
+                self.stats.add("retries")
+                delay = backoff.delay(attempt, e)
                 print(f"Error: {e}")
-                print("Retrying...")
-                time.sleep(time_sleep)
-        return response.choices[0].message.content.strip()
\ No newline at end of file
+                print(f"Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+                continue
+            self.breaker.record(True)
+            if response.choices:
+                return response.choices[0].message.content.strip()
+        self.stats.add("failed")
+        return ""
\ No newline at end of file
@@ -0,0 +1,42 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens"""
+
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        # plain lock, the bucket is shared by threads as well as coroutines and is never held across an await
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens are available, without taking them"""
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            return max(0.0, (amount - self.tokens) / self.rate)
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        Take `amount` tokens now, going into debt if needed, and return the seconds to wait before using them.
+        Later callers queue behind the debt, so reservations are served in order.
+        """
+        # requests larger than the bucket would wait forever, clip them to a full bucket
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self, amount: float = 1.0):
+        await asyncio.sleep(self.reserve(amount))
@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+from collections import Counter, deque
+from email.utils import parsedate_to_datetime
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AuthenticationError,
+    InternalServerError,
+    NotFoundError,
+    PermissionDeniedError,
+    RateLimitError,
+)
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+# wrong key, deployment or model, every following request would fail the same way
+CONFIG_ERRORS = (AuthenticationError, PermissionDeniedError, NotFoundError)
+
+
+def is_retryable(err: Exception) -> bool:
+    if isinstance(err, RETRYABLE_ERRORS):
+        return True
+    if isinstance(err, APIStatusError):
+        return err.status_code in (408, 409, 429) or err.status_code >= 500
+    return False
+
+
+def get_retry_after(err: Exception) -> float | None:
+    """Seconds the server asked us to wait, from `retry-after-ms` or `retry-after` headers"""
+    response = getattr(err, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            value = headers["retry-after"]
+            if value.replace(".", "", 1).isdigit():
+                return float(value)
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+class Backoff:
+    """Exponential backoff with full jitter, a server `Retry-After` takes precedence"""
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, err: Exception | None = None) -> float:
+        retry_after = get_retry_after(err) if err is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    """
+    Opens when the error rate of the requests in the last `window` seconds reaches `error_rate`.
+    While open, every worker sharing the breaker pauses for `cooldown` seconds before sending.
+    """
+
+    def __init__(self, window: float = 60.0, min_requests: int = 20, error_rate: float = 0.5, cooldown: float = 30.0):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.events = deque()
+        self.open_until = 0.0
+        self.n_opens = 0
+        self.lock = threading.Lock()
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        with self.lock:
+            self.events.append((now, ok))
+            while self.events and self.events[0][0] < now - self.window:
+                self.events.popleft()
+            n_errors = sum(1 for _, e_ok in self.events if not e_ok)
+            if len(self.events) >= self.min_requests and n_errors / len(self.events) >= self.error_rate:
+                self.open_until = now + self.cooldown
+                self.n_opens += 1
+                # start a fresh window after the pause
+                self.events.clear()
+
+    def wait_time(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+
+class RetryStats:
+    """Thread-safe counters of requests, retries, throttles and failures"""
+
+    def __init__(self) -> None:
+        self.counter = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, key: str, n: int = 1):
+        with self.lock:
+            self.counter[key] += n
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return dict(self.counter)
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+from src.call_llm.retry import is_retryable
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    """One server or deployment, its clients keep a connection pool alive across requests"""
+
+    def __init__(self, base_url: str, client, async_client, model_name: str | None = None) -> None:
+        self.base_url = base_url
+        self.client = client
+        self.async_client = async_client
+        # deployments of one model may be named differently, None keeps the model name of `GPT`
+        self.model_name = model_name
+        self.outstanding = 0
+        self.n_failures = 0
+        self.n_ejections = 0
+        self.ejected_until = 0.0
+        self.n_requests = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until == 0.0
+
+
+class EndpointRouter:
+    """
+    Route requests to the endpoint with the fewest outstanding requests.
+    An endpoint failing `max_failures` times in a row is ejected, a background thread probes it after
+    `eject_time` seconds (doubled at each failed probe) and re-admits it once it answers again.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        max_failures: int = 3,
+        eject_time: float = 30.0,
+        max_eject_time: float = 600.0,
+        health_check_interval: float = 5.0,
+    ) -> None:
+        self.endpoints = endpoints
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.next_idx = 0
+        # daemon so a finished run never waits for the prober
+        self.health_checker = threading.Thread(target=self._health_check_loop, daemon=True)
+        self.health_checker.start()
+
+    @classmethod
+    def from_urls(cls, urls: list[str], api_key: str, **kwargs) -> "EndpointRouter":
+        endpoints = [
+            Endpoint(
+                url,
+                OpenAI(base_url=url, api_key=api_key, max_retries=0),
+                AsyncOpenAI(base_url=url, api_key=api_key, max_retries=0),
+            )
+            for url in urls
+        ]
+        return cls(endpoints, **kwargs)
+
+    def acquire(self, n_tokens: int = 0) -> tuple[Endpoint, float]:
+        """Pick an endpoint for a request of about `n_tokens` tokens, return it with the seconds to wait before sending"""
+        with self.lock:
+            candidates = [e for e in self.endpoints if e.healthy]
+            if not candidates:
+                # every server is down, keep trying the one probed soonest instead of failing the run
+                candidates = [min(self.endpoints, key=lambda e: e.ejected_until)]
+            # rotate the start so ties do not always land on the first endpoint
+            self.next_idx = (self.next_idx + 1) % len(candidates)
+            candidates = candidates[self.next_idx :] + candidates[: self.next_idx]
+            endpoint = min(candidates, key=lambda e: e.outstanding)
+            endpoint.outstanding += 1
+            endpoint.n_requests += 1
+            return endpoint, 0.0
+
+    def release(self, endpoint: Endpoint, err: Exception | None = None):
+        # bad requests and throttling say nothing about the health of the server
+        failed = err is not None and is_retryable(err) and not isinstance(err, RateLimitError)
+        with self.lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.n_failures = 0
+                return
+            endpoint.n_failures += 1
+            if endpoint.healthy and endpoint.n_failures >= self.max_failures:
+                self._eject(endpoint)
+
+    @contextmanager
+    def use(self, n_tokens: int = 0):
+        """Yield (endpoint, delay) for one request, its outcome is recorded on exit"""
+        endpoint, delay = self.acquire(n_tokens)
+        try:
+            yield endpoint, delay
+        # a hedged request cancelled by its twin must still be released
+        except BaseException as err:
+            self.release(endpoint, err)
+            raise
+        self.release(endpoint)
+
+    def any_healthy(self) -> bool:
+        return any(e.healthy for e in self.endpoints)
+
+    def _eject(self, endpoint: Endpoint):
+        eject_time = min(self.eject_time * 2**endpoint.n_ejections, self.max_eject_time)
+        endpoint.ejected_until = time.monotonic() + eject_time
+        endpoint.n_ejections += 1
+        logger.warning(f"Eject endpoint {endpoint.base_url} for {eject_time:.0f}s after {endpoint.n_failures} failures")
+
+    def _probe(self, endpoint: Endpoint) -> bool:
+        try:
+            endpoint.client.with_options(timeout=5.0).models.list()
+            return True
+        except Exception:
+            return False
+
+    def _health_check_loop(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            now = time.monotonic()
+            for endpoint in self.endpoints:
+                if endpoint.healthy or endpoint.ejected_until > now:
+                    continue
+                ok = self._probe(endpoint)
+                with self.lock:
+                    if ok:
+                        endpoint.ejected_until = 0.0
+                        endpoint.n_failures = 0
+                        endpoint.n_ejections = 0
+                        logger.info(f"Re-admit endpoint {endpoint.base_url}")
+                    else:
+                        self._eject(endpoint)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                e.base_url: {"requests": e.n_requests, "healthy": e.healthy, "outstanding": e.outstanding}
+                for e in self.endpoints
+            }
@@ -0,0 +1,24 @@
+def build_batches(lengths: list[int], max_batch_tokens: int, max_batch_size: int = 0, padded: bool = False) -> list[list[int]]:
+    """
+    Bucket prompt indices by token length into batches whose total tokens fit in `max_batch_tokens`.
+    With `padded`, a batch costs its longest prompt times its size, as with left padding in HF generate.
+    A prompt longer than the budget gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch, batch_tokens = [], 0
+    for i in order:
+        length = lengths[i]
+        if padded:
+            # sorted ascending, so the new prompt is the longest of the batch
+            cost = length * (len(batch) + 1)
+        else:
+            cost = batch_tokens + length
+        if batch and (cost > max_batch_tokens or (max_batch_size > 0 and len(batch) >= max_batch_size)):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += length
+    if batch:
+        batches.append(batch)
+    return batches
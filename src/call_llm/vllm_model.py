@@ -1,12 +1,22 @@
+import logging
 from vllm import LLM, SamplingParams
 
+logger = logging.getLogger(__name__)
+
 
 class VLLMModel:
-    def __init__(self, model_name, **kwargs):
+    def __init__(self, model_name, cache=None, **kwargs):
         self.model_name = model_name
         self.model = LLM(model_name, **kwargs)
+        self.cache = cache
 
     def generate(self, messages: list[str], sampling_params: SamplingParams, max_length=32000) -> list[str]:
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.model_name, messages, sampling_params)
+            response = self.cache.get(key)
+            if response is not None:
+                return response
         tokenizer = self.model.get_tokenizer()
         # check if content is too long
         inputs = tokenizer.encode(messages[-1]['content'], truncation=True, max_length=max_length, add_special_tokens=False)
@@ -16,21 +26,73 @@ class VLLMModel:
             prompt_token_ids=inputs, sampling_params=sampling_params, use_tqdm=False
         )
         response = generation_outputs[0].outputs[0].text.strip()
+        if key is not None:
+            self.cache.set(key, response)
         return response
 
+    def tokenize(self, messages_list: list[list[str]]) -> list[list[int]]:
+        tokenizer = self.model.get_tokenizer()
+        return [tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True) for messages in messages_list]
+
+    def _generate_outputs(self, messages_list, indices, sampling_params, prompt_token_ids=None):
+        if prompt_token_ids is not None:
+            return self.model.generate(
+                prompt_token_ids=[prompt_token_ids[i] for i in indices], sampling_params=sampling_params
+            )
+        tokenizer = self.model.get_tokenizer()
+        prompts = [
+            tokenizer.apply_chat_template(messages_list[i], add_generation_prompt=True, tokenize=False)
+            for i in indices
+        ]
+        return self.model.generate(prompts, sampling_params)
+
     def batch_generate(
         self,
         messages_list: list[list[str]] | list[str],
         sampling_params: SamplingParams,
+        prompt_token_ids: list[list[int]] | None = None,
+        max_tokens: list[int] | None = None,
     ) -> list[str]:
+        """
+        `prompt_token_ids` from `tokenize` skips applying the chat template again.
+        `max_tokens` are per-prompt budgets below the one of `sampling_params`, prompts cut by their budget
+        are generated again with the full one.
+        """
         # if receive single messages, convert to list
         if isinstance(messages_list[0], str):
             messages_list = [messages_list]  # type: ignore
-        tokenizer = self.model.get_tokenizer()
-        prompts = [
-            tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
-            for messages in messages_list
-        ]
-        generation_outputs = self.model.generate(prompts, sampling_params)
-        responses = [o.outputs[0].text for o in generation_outputs]
+        responses = [None] * len(messages_list)
+        keys = [None] * len(messages_list)
+        if self.cache is not None:
+            for i, messages in enumerate(messages_list):
+                keys[i] = self.cache.make_key(self.model_name, messages, sampling_params)
+                responses[i] = self.cache.get(keys[i])
+        # only generate the messages that are not cached
+        indices = [i for i, r in enumerate(responses) if r is None]
+        if not indices:
+            return responses
+        if max_tokens is not None:
+            params = []
+            for i in indices:
+                p = sampling_params.clone()
+                p.max_tokens = min(max_tokens[i], sampling_params.max_tokens)
+                params.append(p)
+        else:
+            params = sampling_params
+        outputs = dict(zip(indices, self._generate_outputs(messages_list, indices, params, prompt_token_ids)))
+        if max_tokens is not None:
+            truncated = [
+                i
+                for i in indices
+                if outputs[i].outputs[0].finish_reason == "length" and max_tokens[i] < sampling_params.max_tokens
+            ]
+            if truncated:
+                logger.info(f"Re-generate {len(truncated)} of {len(indices)} prompts cut by their predicted budget")
+                outputs.update(
+                    zip(truncated, self._generate_outputs(messages_list, truncated, sampling_params, prompt_token_ids))
+                )
+        for i in indices:
+            responses[i] = outputs[i].outputs[0].text
+            if self.cache is not None:
+                self.cache.set(keys[i], responses[i])
         return responses
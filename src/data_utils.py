@@ -1,24 +1,26 @@
 import json
-from src.utils import read_jsonl
+from src.utils import read_jsonl, iter_jsonl
 
 ASPECTS_SPACE = ["general", "rooms", "location", "service", "cleanliness", "building", "food"]
 ASPECTS_AMASUM = ["general"]
 
+def convert_amasum(d):
+    return {
+        "entity_id": d['entity_id'],
+        "reviews": [
+            {
+                "review_id": str(r['review_id']),
+                "review_text": ' '.join([s.strip() for s in  r['sentences']])
+            } for r in d['reviews']
+        ],
+        "summaries": {
+            "general": d['summaries'] 
+        }
+    }
+
 def read_amasum(path):
     data = read_jsonl(path)
-    data = [
-        {
-            "entity_id": d['entity_id'],
-            "reviews": [
-                {
-                    "review_id": str(r['review_id']),
-                    "review_text": ' '.join([s.strip() for s in  r['sentences']])
-                } for r in d['reviews']
-            ],
-            "summaries": {
-                "general": d['summaries'] 
-            }
-        } for d in data ]
+    data = [convert_amasum(d) for d in data]
     return data
 
 def read_space(path):
@@ -46,6 +48,16 @@ def read_data(path, dataset_name):
     assert len(data) > 0
     return data
 
+def iter_data(path, dataset_name):
+    """Yield entities one at a time, only AMASUM (jsonl) is read lazily, SPACE is a single json array"""
+    if dataset_name == "amasum":
+        for d in iter_jsonl(path):
+            yield convert_amasum(d)
+    elif dataset_name == "space":
+        yield from read_space(path)
+    else:
+        raise ValueError()
+
 def read_reviews(path, dataset_name):
     data = []
     if dataset_name == "amasum":
@@ -0,0 +1,90 @@
+import logging
+import re
+import zlib
+from collections import defaultdict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MERSENNE_PRIME = (1 << 31) - 1
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def get_shingles(text: str, n: int = 3) -> set[str]:
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    if len(tokens) < n:
+        return {" ".join(tokens)}
+    return {" ".join(tokens[i : i + n]) for i in range(len(tokens) - n + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, seed: int = 42) -> None:
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+
+    def signature(self, shingles: set[str]) -> np.ndarray:
+        # hashes < 2^31 and a < 2^31, so a * x + b never overflows int64
+        x = np.array([zlib.crc32(s.encode("utf-8")) & MERSENNE_PRIME for s in shingles], dtype=np.int64)
+        return ((np.outer(x, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+
+def cluster_near_duplicates(texts: list[str], threshold: float = 0.9, num_perm: int = 64, bands: int = 16) -> list[list[int]]:
+    """
+    Cluster texts whose estimated Jaccard similarity of word 3-grams is at least `threshold`.
+    Returns clusters of indices, the first index of each cluster being its representative.
+    """
+    hasher = MinHasher(num_perm=num_perm)
+    signatures = [hasher.signature(get_shingles(text)) for text in texts]
+    rows = num_perm // bands
+
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for i, sig in enumerate(signatures):
+            buckets[sig[band * rows : (band + 1) * rows].tobytes()].append(i)
+        for indices in buckets.values():
+            # compare with the first member only, other bands catch the pairs missed here
+            first = indices[0]
+            for i in indices[1:]:
+                if find(i) != find(first) and np.mean(signatures[i] == signatures[first]) >= threshold:
+                    # keep the smallest index as root so the earliest text represents the cluster
+                    root_i, root_first = find(i), find(first)
+                    parent[max(root_i, root_first)] = min(root_i, root_first)
+
+    clusters = defaultdict(list)
+    for i in range(len(texts)):
+        clusters[find(i)].append(i)
+    return list(clusters.values())
+
+
+def dedup_reviews(reviews: list[dict], threshold: float = 0.9) -> tuple[list[dict], dict[tuple, list[dict]]]:
+    """
+    Keep one representative per cluster of near-duplicate reviews.
+    Returns the representatives and a mapping (entity_id, review_id) of a representative -> its duplicates,
+    each duplicate tagged with `duplicate_of`.
+    """
+    clusters = cluster_near_duplicates([r["review_text"] for r in reviews], threshold=threshold)
+    representatives = []
+    duplicates = {}
+    for cluster in sorted(clusters, key=lambda c: c[0]):
+        representative = reviews[cluster[0]]
+        representatives.append(representative)
+        if len(cluster) > 1:
+            key = (representative["entity_id"], representative["review_id"])
+            duplicate_of = {"entity_id": key[0], "review_id": key[1]}
+            duplicates[key] = [{**reviews[i], "duplicate_of": duplicate_of} for i in cluster[1:]]
+    n_saved = len(reviews) - len(representatives)
+    logger.info(
+        f"Dedup: {len(representatives)} representatives for {len(reviews)} reviews, "
+        f"saved {n_saved} extraction calls ({n_saved / max(len(reviews), 1):.1%})"
+    )
+    return representatives, duplicates
@@ -1,13 +1,27 @@
 import argparse
+import asyncio
 import json
+import logging
 import os
+import re
+from functools import partial
 from src import prompt_template
 from src.config import cfg
 from tqdm import tqdm
-from src.utils import setup_logger, write_jsonl, prepare_file
+from src.utils import setup_logger, write_jsonl
 from src.data_utils import read_reviews
+from src.call_llm.rate_limiter import TokenBucket
+from src.call_llm.cache import ResponseCache
+from src.journal import Journal, truncate_partial_line
+from src.call_llm.scheduler import build_batches
+from src.dedup import dedup_reviews
+from src.prefilter import ReviewPrefilter
+from src.length_predictor import OutputLengthPredictor
+from src.parse import ExtractionStreamGuard
 
-logger = None
+logger = logging.getLogger(__name__)
+
+REVIEW_ID_PATTERN = re.compile(r"#Review id:\s*(\S+)")
 
 
 def get_messages(reviews: list[str], extraction_prompt: str) -> list[list[dict[str, str]]]:
@@ -16,23 +30,177 @@ def get_messages(reviews: list[str], extraction_prompt: str) -> list[list[dict[s
     return messages_list
 
 
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English text, good enough for budgeting
+    return len(text) // 4 + 1
+
+
+def pack_reviews(reviews: list[dict], token_budget: int, max_reviews: int) -> list[list[dict]]:
+    """Group consecutive reviews of the same entity while their texts fit in `token_budget`"""
+    groups = []
+    group, n_tokens = [], 0
+    for review in reviews:
+        review_tokens = estimate_tokens(review["review_text"])
+        if group and (
+            review["entity_id"] != group[0]["entity_id"]
+            or n_tokens + review_tokens > token_budget
+            or len(group) >= max_reviews
+        ):
+            groups.append(group)
+            group, n_tokens = [], 0
+        group.append(review)
+        n_tokens += review_tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+def get_packed_messages(groups: list[list[dict]], packed_prompt: str) -> list[list[dict[str, str]]]:
+    messages_list = []
+    for group in groups:
+        reviews = "\n".join([f"#Review id: {r['review_id']}\n{r['review_text']}" for r in group])
+        messages_list.append([{"role": "user", "content": packed_prompt.format(reviews=reviews)}])
+    return messages_list
+
+
+def split_packed_response(group: list[dict], response: str) -> list[str]:
+    """Assign the `#Aspect name:` blocks following each `#Review id:` line back to that review"""
+    matches = list(REVIEW_ID_PATTERN.finditer(response))
+    if not matches and len(group) == 1:
+        return [response]
+    segments = {}
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(response)
+        review_id = m.group(1).strip(".,:;")
+        segments[review_id] = (segments.get(review_id, "") + "\n" + response[m.end() : end]).strip()
+    unknown_ids = set(segments) - set(r["review_id"] for r in group)
+    if unknown_ids:
+        logger.debug(f"Dropped output of unknown review ids: {unknown_ids}")
+    return [segments.get(r["review_id"], "") for r in group]
+
+
 def check_processed_data(path):
-    cnt = 0
+    """Return (entity_id, review_id) of reviews already written to `path`"""
+    processed_ids = set()
     if os.path.isfile(path):
         with open(path) as fin:
-            for _ in fin:
-                cnt += 1
-    logger.info(f"Processed {cnt} reviews")
-    return cnt
+            for line in fin:
+                if line.strip() == "":
+                    continue
+                obj = json.loads(line)
+                processed_ids.add((obj["entity_id"], obj["review_id"]))
+    logger.info(f"Processed {len(processed_ids)} reviews")
+    return processed_ids
+
+
+def load_journal(journal_path, output_path):
+    # reviews of a batch cut off by a crash are not journaled and are generated again, appended after it
+    truncate_partial_line(output_path)
+    journal = Journal(journal_path)
+    # outputs written before the journal existed
+    if len(journal) == 0:
+        journal.extend([Journal.key(*ids) for ids in check_processed_data(output_path)])
+    return journal
 
 
-def write_output(reviews, responses, output_path):
+def write_output(reviews, responses, output_path, journal=None, verbose=True):
     output = []
     for review, response in zip(reviews, responses):
         obj = {"entity_id": review["entity_id"], "review_id": review["review_id"], "response": response}
+        for key in ("duplicate_of", "prefiltered"):
+            if key in review:
+                obj[key] = review[key]
         output.append(obj)
     write_jsonl(output, output_path, mode="a", verbose=False)
-    logger.info(f"Write {len(reviews)} lines to `{output_path}`")
+    # record only after the outputs are on disk
+    if journal is not None:
+        journal.extend([Journal.key(r["entity_id"], r["review_id"]) for r in reviews])
+    if verbose:
+        logger.info(f"Write {len(reviews)} lines to `{output_path}`")
+
+
+def expand_outputs(group, response, packed, duplicates=None):
+    """Split a response back to the reviews of its prompt and copy it to their near-duplicates"""
+    responses = split_packed_response(group, response) if packed else [response]
+    if not duplicates:
+        return group, responses
+    reviews_out, responses_out = [], []
+    for review, r in zip(group, responses):
+        members = duplicates.get((review["entity_id"], review["review_id"]), [])
+        reviews_out.extend([review] + members)
+        responses_out.extend([r] * (len(members) + 1))
+    return reviews_out, responses_out
+
+
+def get_request_params(sampling_params, budget=None):
+    """Sampling params of one request with its predicted budget, and the max_tokens to re-issue it with if cut"""
+    if budget is None or budget >= sampling_params["max_tokens"]:
+        return sampling_params, None
+    return {**sampling_params, "max_tokens": budget}, sampling_params["max_tokens"]
+
+
+async def generate_async(
+    model,
+    groups,
+    messages_list,
+    sampling_params,
+    output_path,
+    concurrency,
+    requests_per_minute,
+    p_bar,
+    journal=None,
+    packed=False,
+    duplicates=None,
+    budgets=None,
+    guard=None,
+):
+    """Keep `concurrency` requests in flight and write each response as soon as it completes"""
+    limiter = None
+    if requests_per_minute > 0:
+        limiter = TokenBucket(rate=requests_per_minute / 60, capacity=concurrency)
+    jobs = iter(zip(groups, messages_list, budgets or [None] * len(groups)))
+
+    async def worker():
+        # workers share one iterator, so every prompt is taken exactly once
+        for group, messages, budget in jobs:
+            if limiter is not None:
+                await limiter.acquire()
+            params, retry_max_tokens = get_request_params(sampling_params, budget)
+            response = await model.agenerate(messages, params, retry_max_tokens=retry_max_tokens, guard=guard)
+            # no await while writing, so lines of concurrent workers never interleave
+            out_reviews, out_responses = expand_outputs(group, response, packed, duplicates)
+            write_output(out_reviews, out_responses, output_path, journal=journal, verbose=False)
+            p_bar.update(len(out_reviews))
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+def run_batch_job(model, groups, messages_list, sampling_params, stage, batch_dir, output_path, journal, packed, duplicates):
+    """
+    Offline extraction through the Batch API.
+    `write` only writes request files, `run` also submits and waits, both `run` and `ingest` then write the
+    results to `output_path` by custom_id, which holds the (entity_id, review_id) of every review of the prompt.
+    """
+    from src.call_llm.batch_job import BatchJob
+
+    job = BatchJob(model, batch_dir)
+    keys = [[[r["entity_id"], r["review_id"]] for r in group] for group in groups]
+    job.prepare(list(zip(keys, messages_list)), sampling_params)
+    if stage == "write":
+        return
+    if stage == "run":
+        job.submit()
+        job.wait()
+    n_ingested = 0
+    for key, response in job.iter_results():
+        group = [{"entity_id": entity_id, "review_id": review_id} for entity_id, review_id in key]
+        if all(Journal.key(r["entity_id"], r["review_id"]) in journal for r in group):
+            continue
+        out_reviews, out_responses = expand_outputs(group, response, packed, duplicates)
+        write_output(out_reviews, out_responses, output_path, journal=journal, verbose=False)
+        n_ingested += len(out_reviews)
+    logger.info(f"Ingested {n_ingested} reviews from `{batch_dir}`")
+    job.cleanup()
 
 
 def main():
@@ -44,6 +212,41 @@ def main():
     parser.add_argument("--model_name", type=str, default="mistral")
     parser.add_argument("--exp_name", type=str, help="Name of the experiment", default="test")
     parser.add_argument("--output_path", type=str, default=None)
+    parser.add_argument("--async_mode", action="store_true", default=False, help="Send concurrent requests to GPT")
+    parser.add_argument("--concurrency", type=int, default=16, help="Max in-flight requests in async mode")
+    parser.add_argument("--requests_per_minute", type=float, default=0, help="Rate limit in async mode, 0 to disable")
+    parser.add_argument("--cache_path", type=str, default=None, help="SQLite file to cache LLM responses")
+    parser.add_argument("--cache_max_size_mb", type=float, default=0, help="Evict cached responses above this size")
+    parser.add_argument("--journal_path", type=str, default=None, help="Resume journal, default `<output_path>.journal`")
+    parser.add_argument(
+        "--pack_token_budget", type=int, default=0, help="Pack reviews of an entity into one prompt, 0 to disable"
+    )
+    parser.add_argument("--pack_max_reviews", type=int, default=8, help="Max reviews per packed prompt")
+    parser.add_argument(
+        "--dedup_threshold", type=float, default=0, help="Skip reviews this similar to an extracted one, 0 to disable"
+    )
+    parser.add_argument(
+        "--batch_stage", type=str, default=None, choices=["write", "run", "ingest"], help="Use the GPT Batch API"
+    )
+    parser.add_argument("--batch_dir", type=str, default=None, help="Batch request/result files, default `<output_path>.batch`")
+    parser.add_argument("--prefilter_path", type=str, default=None, help="Trained `prefilter.py` model, None to disable")
+    parser.add_argument("--prefilter_recall", type=float, default=0.99, help="Target recall of reviews with tuples")
+    parser.add_argument(
+        "--vllm_batch_tokens", type=int, default=0, help="Token budget (prompt + max_tokens) per vLLM batch, 0 to disable"
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="text",
+        choices=["text", "json"],
+        help="`json` asks for compact JSON tuples under a schema enforced by constrained decoding",
+    )
+    parser.add_argument(
+        "--stream_guard", action="store_true", default=False, help="Stream GPT responses and stop degenerate ones early"
+    )
+    parser.add_argument(
+        "--length_predictor_path", type=str, default=None, help="Fitted `length_predictor.py` model, None for global max_tokens"
+    )
     args = parser.parse_args()
 
     cfg.update(args)
@@ -60,70 +263,182 @@ def main():
 
     # Check processed examples
     output_path = cfg.CONF["output_path"]
-    n_processed = check_processed_data(output_path)
-    reviews = reviews[n_processed:]
+    journal = load_journal(cfg.CONF["journal_path"] or f"{output_path}.journal", output_path)
+    reviews = [r for r in reviews if Journal.key(r["entity_id"], r["review_id"]) not in journal]
+    logger.info(f"Remaining {len(reviews)} reviews")
+    n_reviews = len(reviews)
+
+    # Extract one representative per cluster of near-duplicates, its output is copied to the others
+    duplicates = {}
+    if cfg.CONF["dedup_threshold"] > 0:
+        reviews, duplicates = dedup_reviews(reviews, threshold=cfg.CONF["dedup_threshold"])
+
+    # Reviews predicted to yield no valid tuple get an empty response instead of a generation
+    if cfg.CONF["prefilter_path"]:
+        prefilter = ReviewPrefilter.load(cfg.CONF["prefilter_path"])
+        reviews, skipped = prefilter.filter(reviews, recall=cfg.CONF["prefilter_recall"])
+        for review in skipped:
+            out_reviews, out_responses = expand_outputs([{**review, "prefiltered": True}], "", False, duplicates)
+            write_output(out_reviews, out_responses, output_path, journal=journal, verbose=False)
+
+    packed = cfg.CONF["pack_token_budget"] > 0
+    json_output = cfg.CONF["output_format"] == "json"
+    if packed and json_output:
+        raise ValueError("Packed prompts are split on `#Review id:` lines, use the text output format")
+    max_tokens = cfg.CONF['extraction']["max_tokens"]
+    if packed:
+        groups = pack_reviews(reviews, cfg.CONF["pack_token_budget"], cfg.CONF["pack_max_reviews"])
+        packed_prompt = prompt_template.PROMPT_EXTRACTION_PACKED[dataset_name].strip()
+        messages_list = get_packed_messages(groups, packed_prompt)
+        # the output budget is per review
+        max_tokens *= cfg.CONF["pack_max_reviews"]
+        logger.info(f"Packed {len(reviews)} reviews into {len(groups)} prompts")
+    else:
+        groups = [[r] for r in reviews]
+        prompts = prompt_template.PROMPT_EXTRACTION_JSON if json_output else prompt_template.PROMPT_EXTRACTION
+        extraction_prompt = prompts[dataset_name].strip()
+        messages_list = get_messages(reviews, extraction_prompt)
+
+    # Per-prompt max_tokens, a response cut by its budget is generated again with `max_tokens`
+    budgets = None
+    if cfg.CONF["length_predictor_path"]:
+        predictor = OutputLengthPredictor.load(cfg.CONF["length_predictor_path"])
+        review_max_tokens = cfg.CONF['extraction']["max_tokens"]
+        budgets = [
+            min(predictor.predict_group([r["review_text"] for r in group], review_max_tokens), max_tokens)
+            for group in groups
+        ]
+        logger.info(f"Predicted max_tokens: mean {sum(budgets) / max(len(budgets), 1):.0f} instead of {max_tokens}")
 
-    extraction_prompt = prompt_template.PROMPT_EXTRACTION[dataset_name].strip()
-    messages_list = get_messages(reviews, extraction_prompt)
+    cache = None
+    if cfg.CONF["cache_path"]:
+        cache = ResponseCache(cfg.CONF["cache_path"], max_size_mb=cfg.CONF["cache_max_size_mb"])
 
-    p_bar = tqdm(total=len(reviews), desc="Reviews", ncols=0)
+    p_bar = tqdm(total=n_reviews, desc="Reviews", ncols=0)
     if "gpt" in cfg.CONF["model_name"]:
         logger.info("Generate by GPT")
         from src.call_llm.gpt import GPT
 
         model_config = cfg.OPENAI_CONF[cfg.CONF["model_name"]]
-        model = GPT(**model_config)
+        model = GPT(**model_config, cache=cache)
         sampling_params = {
-            "max_tokens": cfg.CONF['extraction']["max_tokens"],
+            "max_tokens": max_tokens,
             "temperature": cfg.CONF['extraction']["temperature"],
             "top_p": cfg.CONF['extraction']["top_p"],
             # "top_k": cfg.conf["top_k"],
         }
-        prepare_file(output_path)
-        fout = open(output_path)
-        for review, messages in zip(reviews, messages_list):
-            response = model.generate(messages, **sampling_params)
-            obj = {
-                "entity_id": review["entity_id"],
-                "review_id": review["review_id"],
-                "response": response,
+        if json_output:
+            # structured outputs of OpenAI/Azure, also served by vLLM's OpenAI-compatible server
+            sampling_params["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "extraction",
+                    "schema": prompt_template.EXTRACTION_JSON_SCHEMA[dataset_name],
+                    "strict": True,
+                },
             }
-            json.dump(obj, fout)
-            fout.write("\n")
-            p_bar.update(1)
+        # parses the stream as it arrives, a looping or malformed generation is cut keeping its valid tuples
+        guard = partial(ExtractionStreamGuard, dataset_name) if cfg.CONF["stream_guard"] else None
+        if cfg.CONF["batch_stage"]:
+            # batch results are billed by generated tokens and never re-issued, they keep the global budget
+            run_batch_job(
+                model,
+                groups,
+                messages_list,
+                sampling_params,
+                stage=cfg.CONF["batch_stage"],
+                batch_dir=cfg.CONF["batch_dir"] or f"{output_path}.batch",
+                output_path=output_path,
+                journal=journal,
+                packed=packed,
+                duplicates=duplicates,
+            )
+        elif cfg.CONF["async_mode"]:
+            asyncio.run(
+                generate_async(
+                    model,
+                    groups,
+                    messages_list,
+                    sampling_params,
+                    output_path,
+                    concurrency=cfg.CONF["concurrency"],
+                    requests_per_minute=cfg.CONF["requests_per_minute"],
+                    p_bar=p_bar,
+                    journal=journal,
+                    packed=packed,
+                    duplicates=duplicates,
+                    budgets=budgets,
+                    guard=guard,
+                )
+            )
+        else:
+            for group, messages, budget in zip(groups, messages_list, budgets or [None] * len(groups)):
+                params, retry_max_tokens = get_request_params(sampling_params, budget)
+                response = model.generate(messages, params, retry_max_tokens=retry_max_tokens, guard=guard)
+                out_reviews, out_responses = expand_outputs(group, response, packed, duplicates)
+                write_output(out_reviews, out_responses, output_path, journal=journal, verbose=False)
+                p_bar.update(len(out_reviews))
         logger.info(f"Saved reponses to `{output_path}`")
+        logger.info(f"GPT request stats: {model.get_stats()}")
     else:
         # use mistral
         logger.info("Generate by vLLM")
-        from vllm import LLM, SamplingParams
+        from vllm import SamplingParams
+        from src.call_llm.vllm_model import VLLMModel
 
         sampling_params = {
-            "max_tokens": cfg.CONF['extraction']["max_tokens"],
+            "max_tokens": max_tokens,
             "temperature": cfg.CONF['extraction']["temperature"],
             "top_p": cfg.CONF['extraction']["top_p"],
             "top_k": cfg.CONF['extraction']["top_k"],
         }
+        if json_output:
+            from vllm.sampling_params import GuidedDecodingParams
+
+            sampling_params["guided_decoding"] = GuidedDecodingParams(json=prompt_template.EXTRACTION_JSON_SCHEMA[dataset_name])
         sampling_params = SamplingParams(**sampling_params)
         model_config = cfg.HF_CONF["mistral"]
-        model = LLM(
-            model_config["model_path"], swap_space=4, dtype=model_config["dtype"], seed=42, gpu_memory_utilization=0.9
+        model = VLLMModel(
+            model_config["model_path"],
+            cache=cache,
+            swap_space=4,
+            dtype=model_config["dtype"],
+            seed=42,
+            gpu_memory_utilization=0.9,
         )
-        tokenizer = model.get_tokenizer()
-        prompts = [
-            tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
-            for messages in messages_list
-        ]
 
-        # Generate
-        L = len(prompts)
+        # Tokenize once and bucket prompts of similar length under a token budget
+        prompt_token_ids = model.tokenize(messages_list)
         batch_size = cfg.CONF["vllm_batch_size"]
-        for start_idx in range(0, L, batch_size):
-            end_idx = min(L, start_idx + batch_size)
-            responses = model.generate(prompts[start_idx:end_idx], sampling_params=sampling_params)
-            responses = [r.outputs[0].text.strip() for r in responses]
-            write_output(reviews[start_idx:end_idx], responses, output_path)
-            p_bar.update(end_idx-start_idx)
+        if cfg.CONF["vllm_batch_tokens"] > 0:
+            # predicted budgets let more short prompts share a batch
+            lengths = [len(ids) + (budgets[i] if budgets else max_tokens) for i, ids in enumerate(prompt_token_ids)]
+            batches = build_batches(lengths, cfg.CONF["vllm_batch_tokens"], max_batch_size=batch_size)
+        else:
+            L = len(messages_list)
+            batches = [list(range(i, min(L, i + batch_size))) for i in range(0, L, batch_size)]
+        logger.info(f"Scheduled {len(messages_list)} prompts into {len(batches)} batches")
+
+        # Generate
+        for batch in batches:
+            responses = model.batch_generate(
+                [messages_list[i] for i in batch],
+                sampling_params=sampling_params,
+                prompt_token_ids=[prompt_token_ids[i] for i in batch],
+                max_tokens=[budgets[i] for i in batch] if budgets else None,
+            )
+            batch_reviews, batch_responses = [], []
+            # outputs are keyed by review, so batches may run out of dataset order
+            for group, response in zip([groups[i] for i in batch], responses):
+                out_reviews, out_responses = expand_outputs(group, response.strip(), packed, duplicates)
+                batch_reviews.extend(out_reviews)
+                batch_responses.extend(out_responses)
+            write_output(batch_reviews, batch_responses, output_path, journal=journal)
+            p_bar.update(len(batch_reviews))
     p_bar.close()
+    journal.close()
+    if cache is not None:
+        cache.close()
 
 if __name__ == "__main__":
     main()
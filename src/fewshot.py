@@ -1,6 +1,7 @@
 import os
 import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from src.config import cfg
 from src.prompt_template import PROMPT_COT, PROMPT_ZERO_SHOT, PROMPT_FEW_SHOT, N_SHOT_EXAMPLES
@@ -8,6 +9,8 @@ from src.utils import setup_logger, read_jsonl, write_jsonl
 from src.eval import calc_rouge
 from src.call_llm.vllm_model import VLLMModel
 from src.call_llm.gpt import GPT
+from src.call_llm.cache import ResponseCache
+from src.journal import Journal, truncate_partial_line
 from src.data_utils import read_data, ASPECTS_AMASUM, ASPECTS_SPACE
 
 
@@ -67,6 +70,8 @@ class FewShot:
     def get_processed_data(self, output_path):
         data = []
         if os.path.isfile(output_path):
+            # a prediction cut off by a crash is not journaled, it is written again after this line
+            truncate_partial_line(output_path)
             data = read_jsonl(output_path)
 
         logger.info(f"Processed data: {len(data)} lines")
@@ -98,53 +103,63 @@ class FewShot:
         group_size=1,
         save_every=1,
         iterative_summarize=False,
+        journal_path=None,
+        concurrency=1,
     ):
         # data config
         aspects = ASPECTS_AMASUM if dataset_name == "amasum" else ASPECTS_SPACE
 
         # Get processed data
         processed_data = self.get_processed_data(output_path)
+        journal = Journal(journal_path or f"{output_path}.journal")
+        # predictions written before the journal existed
+        if len(journal) == 0:
+            journal.extend([Journal.key(d["entity_id"], aspect=d["aspect"]) for d in processed_data])
 
         for aspect in aspects:
             logger.info(f"Processing aspect: {aspect}")
 
             # Initialize reference and generated summaries
             processed_predictions = [d for d in processed_data if d["aspect"] == aspect]
-            processed_entity_ids = [d["entity_id"] for d in processed_predictions]
             gold_summaries = [
                 {"entity_id": entity["entity_id"], "aspect": aspect, "summaries": entity["summaries"][aspect]}
                 for entity in data
-                if entity["entity_id"] in processed_entity_ids
+                if Journal.key(entity["entity_id"], aspect=aspect) in journal
             ]
 
             # Process each data item to get reference and generated summary
+            pending = [
+                entity
+                for entity in data
+                if Journal.key(entity["entity_id"], aspect=aspect) not in journal and aspect in entity["summaries"]
+            ]
+
+            def predict(entity):
+                review_texts = self.get_review_texts(entity)
+                if iterative_summarize:
+                    # iterative summarization
+                    return self.iterative_summarize(review_texts, group_size, dataset_name, aspect, sampling_params)
+                # zeroshot, fewshot or chain of thought summarization
+                return self.summarize(" ".join(review_texts), dataset_name, aspect, sampling_params)
+
+            # threads keep several requests in flight, `map` still yields predictions in data order
+            executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+            results = executor.map(predict, pending) if executor else map(predict, pending)
+
             predictions = []
             cnt = 0
             prediction_container = []
-            for entity in tqdm(
-                data,
-                total=len(data),
+            for entity, prediction in tqdm(
+                zip(pending, results),
+                total=len(pending),
                 desc=f"Summarize aspect: {aspect.upper()}",
                 ncols=0,
             ):
-                if entity["entity_id"] in processed_entity_ids or aspect not in entity["summaries"]:
-                    continue
-
                 # append directly to gold summaries because we dont savee them to disk
                 gold_summaries.append(
                     {"entity_id": entity["entity_id"], "aspect": aspect, "summaries": entity["summaries"][aspect]}
                 )
 
-                review_texts = self.get_review_texts(entity)
-                if iterative_summarize:
-                    # iterative summarization
-                    prediction = self.iterative_summarize(
-                        review_texts, group_size, dataset_name, aspect, sampling_params
-                    )
-                else:
-                    # zeroshot, fewshot or chain of thought summarization
-                    prediction = self.summarize(" ".join(review_texts), dataset_name, aspect, sampling_params)
-
                 prediction_container.append(
                     {"entity_id": entity["entity_id"], "aspect": aspect, "summaries": [prediction]}
                 )
@@ -152,13 +167,17 @@ class FewShot:
                 if cnt >= save_every:
                     # Save the generated summary to the file
                     write_jsonl(prediction_container, output_path, mode="a", verbose=False)
+                    journal.extend([Journal.key(d["entity_id"], aspect=aspect) for d in prediction_container])
                     # Reset counter
                     predictions.extend(prediction_container)
                     prediction_container = []
                     cnt = 0
+            if executor is not None:
+                executor.shutdown()
 
             if len(prediction_container) > 0:
                 write_jsonl(prediction_container, output_path, mode="a", verbose=False)
+                journal.extend([Journal.key(d["entity_id"], aspect=aspect) for d in prediction_container])
                 predictions.extend(prediction_container)
                 prediction_container = []
 
@@ -166,6 +185,64 @@ class FewShot:
             predictions = processed_predictions + predictions
             # Evaluate the generated summaries against the reference summaries
             self.evaluate(predictions, gold_summaries, aspect, eval_output_path)
+        journal.close()
+
+
+    def process_batch(
+        self,
+        data,
+        dataset_name,
+        eval_output_path,
+        output_path,
+        sampling_params,
+        stage,
+        batch_dir,
+        journal_path=None,
+    ):
+        """Summarize every (entity, aspect) through the Batch API, see `extract.run_batch_job` for the stages"""
+        from src.call_llm.batch_job import BatchJob
+
+        aspects = ASPECTS_AMASUM if dataset_name == "amasum" else ASPECTS_SPACE
+        journal = Journal(journal_path or f"{output_path}.journal")
+        if len(journal) == 0:
+            journal.extend([Journal.key(d["entity_id"], aspect=d["aspect"]) for d in self.get_processed_data(output_path)])
+
+        requests = []
+        for aspect in aspects:
+            for entity in data:
+                if Journal.key(entity["entity_id"], aspect=aspect) in journal or aspect not in entity["summaries"]:
+                    continue
+                text = " ".join(self.get_review_texts(entity))
+                requests.append(([entity["entity_id"], aspect], self.build_messages(text, dataset_name, aspect)))
+
+        job = BatchJob(self.llm, batch_dir)
+        job.prepare(requests, sampling_params)
+        if stage == "write":
+            journal.close()
+            return
+        if stage == "run":
+            job.submit()
+            job.wait()
+        for (entity_id, aspect), prediction in job.iter_results():
+            if Journal.key(entity_id, aspect=aspect) in journal:
+                continue
+            write_jsonl([{"entity_id": entity_id, "aspect": aspect, "summaries": [prediction]}], output_path, mode="a", verbose=False)
+            journal.add(Journal.key(entity_id, aspect=aspect))
+        job.cleanup()
+        journal.close()
+
+        # Evaluate everything written so far
+        processed_data = self.get_processed_data(output_path)
+        for aspect in aspects:
+            predictions = [d for d in processed_data if d["aspect"] == aspect]
+            entity_ids = set(d["entity_id"] for d in predictions)
+            gold_summaries = [
+                {"entity_id": entity["entity_id"], "aspect": aspect, "summaries": entity["summaries"][aspect]}
+                for entity in data
+                if entity["entity_id"] in entity_ids
+            ]
+            if predictions:
+                self.evaluate(predictions, gold_summaries, aspect, eval_output_path)
 
 
 def main():
@@ -180,7 +257,15 @@ def main():
     parser.add_argument("--save_every", type=int, default=1)
     parser.add_argument("--group_size", type=int, default=1)
     parser.add_argument("--iterative_summarize", action="store_true", default=False)
+    parser.add_argument("--concurrency", type=int, default=1, help="Max in-flight GPT requests")
 
+    parser.add_argument("--cache_path", type=str, default=None, help="SQLite file to cache LLM responses")
+    parser.add_argument("--cache_max_size_mb", type=float, default=0, help="Evict cached responses above this size")
+    parser.add_argument(
+        "--batch_stage", type=str, default=None, choices=["write", "run", "ingest"], help="Use the GPT Batch API"
+    )
+    parser.add_argument("--batch_dir", type=str, default=None, help="Batch request/result files, default `<output_path>.batch`")
+    parser.add_argument("--journal_path", type=str, default=None, help="Resume journal, default `<output_path>.journal`")
     args = parser.parse_args()
 
     cfg.update(args)
@@ -193,11 +278,15 @@ def main():
     dataset_name = cfg.CONF["dataset"]
     data_path = cfg.DATA_CONF[dataset_name]["test_path"]
 
+    cache = None
+    if cfg.CONF["cache_path"]:
+        cache = ResponseCache(cfg.CONF["cache_path"], max_size_mb=cfg.CONF["cache_max_size_mb"])
+
     model_name = cfg.CONF["model_name"]
     if "gpt" in model_name:
         logger.info("Generate by GPT")
         model_config = cfg.OPENAI_CONF[model_name]
-        llm = GPT(**model_config)
+        llm = GPT(**model_config, cache=cache)
         sampling_params = {
             "max_tokens": cfg.CONF["summarization"]["max_tokens"],
             "temperature": cfg.CONF["summarization"]["temperature"],
@@ -220,6 +309,7 @@ def main():
         model_config = cfg.HF_CONF[model_name]
         llm = VLLMModel(
             model_name=model_config["model_path"],
+            cache=cache,
             swap_space=4,
             dtype=model_config["dtype"],
             seed=42,
@@ -229,6 +319,22 @@ def main():
     data = read_data(path=data_path, dataset_name=dataset_name)
 
     fs = FewShot(llm, mode=cfg.CONF["mode"])
+    if cfg.CONF["batch_stage"]:
+        if "gpt" not in model_name or cfg.CONF["iterative_summarize"]:
+            raise ValueError("Batch mode needs a GPT model and single-round summarization")
+        fs.process_batch(
+            data=data,
+            dataset_name=cfg.CONF["dataset"],
+            output_path=cfg.CONF["output_path"],
+            eval_output_path=cfg.CONF["eval_output_path"],
+            sampling_params=sampling_params,
+            stage=cfg.CONF["batch_stage"],
+            batch_dir=cfg.CONF["batch_dir"] or f"{cfg.CONF['output_path']}.batch",
+            journal_path=cfg.CONF["journal_path"],
+        )
+        if cache is not None:
+            cache.close()
+        return
     fs.process(
         data=data,
         dataset_name=cfg.CONF["dataset"],
@@ -238,7 +344,14 @@ def main():
         sampling_params=sampling_params,
         save_every=cfg.CONF["save_every"],
         iterative_summarize=cfg.CONF["iterative_summarize"],
+        journal_path=cfg.CONF["journal_path"],
+        # vLLM generates in-process, only remote requests benefit from threads
+        concurrency=cfg.CONF["concurrency"] if isinstance(llm, GPT) else 1,
     )
+    if isinstance(llm, GPT):
+        logger.info(f"GPT request stats: {llm.get_stats()}")
+    if cache is not None:
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Every MERGE/MATCH of `push_graph.py` starts from an Entity by (entity_id, exp_name) or from nodes of one
+# entity, these keep them index seeks instead of label scans as the graph grows.
+# Feature and Opinion keys are not unique: MERGE of a whole path creates a Feature per aspect
+# and an Opinion per feature.
+SCHEMA = [
+    "CREATE CONSTRAINT entity_key IF NOT EXISTS FOR (e:Entity) REQUIRE (e.entity_id, e.exp_name) IS UNIQUE",
+    "CREATE INDEX entity_exp_name IF NOT EXISTS FOR (e:Entity) ON (e.exp_name)",
+    "CREATE INDEX aspect_key IF NOT EXISTS FOR (a:Aspect) ON (a.entity_id, a.exp_name, a.name)",
+    "CREATE INDEX feature_key IF NOT EXISTS FOR (f:Feature) ON (f.entity_id, f.exp_name, f.name)",
+    "CREATE INDEX opinion_key IF NOT EXISTS FOR (o:Opinion) ON (o.entity_id, o.exp_name, o.name)",
+]
+# plan operators reading every node (of a label), their cost grows with the database
+SCAN_OPERATORS = {"AllNodesScan", "NodeByLabelScan"}
+
+
+def ensure_schema(driver, database, timeout=300):
+    """Create the constraints and indexes, a no-op for those that exist, and wait until they are online"""
+    for cmd in SCHEMA:
+        driver.execute_query(cmd, database_=database)
+    driver.execute_query("CALL db.awaitIndexes($timeout)", timeout=timeout, database_=database)
+    logger.info(f"Graph schema ready: {len(SCHEMA)} constraints and indexes")
+
+
+def iter_operators(plan):
+    """Yield the operator names of a plan tree, as returned in `ResultSummary.plan`"""
+    # Neo4j 5 suffixes operators with the runtime, e.g. `NodeByLabelScan@neo4j`
+    yield plan["operatorType"].split("@")[0]
+    for child in plan.get("children", []):
+        yield from iter_operators(child)
+
+
+def check_query_plans(driver, queries, database, strict=False):
+    """
+    EXPLAIN each of `queries` ({name: (cmd, params)}) and report plans scanning a whole label.
+    EXPLAIN only plans the query, so write queries are safe to check; PROFILE would run them.
+    With `strict`, a scan raises instead of logging a warning.
+    """
+    bad = {}
+    for name, (cmd, params) in queries.items():
+        _, summary, _ = driver.execute_query(f"EXPLAIN {cmd}", parameters_=params, database_=database)
+        scans = sorted(set(iter_operators(summary.plan)) & SCAN_OPERATORS)
+        if scans:
+            bad[name] = scans
+    for name, scans in bad.items():
+        logger.warning(f"Query `{name}` plans {', '.join(scans)}, its cost will grow with the database")
+    if bad and strict:
+        raise RuntimeError(f"Label scans in the plans of {list(bad)}, check the graph schema")
+    if not bad:
+        logger.info(f"No label scan in the plans of {len(queries)} queries")
+    return bad
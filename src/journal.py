@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+from src.utils import prepare_file
+
+logger = logging.getLogger(__name__)
+
+
+def truncate_partial_line(path: str, chunk_size: int = 1 << 16) -> int:
+    """
+    Drop the trailing line of an append-only file cut off by a crash, otherwise the next append would be
+    glued to it. Only the tail is read. Return the number of bytes dropped.
+    """
+    if not os.path.isfile(path):
+        return 0
+    with open(path, "r+b") as f:
+        size = end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            logger.warning(f"Truncating {size - end} bytes of partial line in `{path}`")
+            f.truncate(end)
+    return size - end
+
+
+class Journal:
+    """
+    Append-only record of completed work units, keyed by (entity_id, review_id, aspect).
+    Each unit is one JSON line written with a single append, so a crash can only lose the last partial line.
+    Unused key parts are None, e.g. extraction uses (entity_id, review_id, None).
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.keys = set()
+        prepare_file(path)
+        if os.path.isfile(path):
+            self._load()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        logger.info(f"Journal `{path}` has {len(self.keys)} completed units")
+
+    @staticmethod
+    def key(entity_id, review_id=None, aspect=None) -> tuple:
+        return (entity_id, review_id, aspect)
+
+    def _load(self):
+        truncate_partial_line(self.path)
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    self.keys.add(tuple(json.loads(line)))
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, key: tuple) -> None:
+        self.extend([key])
+
+    def extend(self, keys: list[tuple]) -> None:
+        keys = [tuple(k) for k in keys if tuple(k) not in self.keys]
+        if not keys:
+            return
+        data = "".join(json.dumps(list(k)) + "\n" for k in keys).encode("utf-8")
+        os.write(self.fd, data)
+        os.fsync(self.fd)
+        self.keys.update(keys)
+
+    def close(self):
+        os.close(self.fd)
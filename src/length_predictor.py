@@ -0,0 +1,131 @@
+import argparse
+import logging
+import math
+import random
+import re
+import numpy as np
+from src.config import cfg
+from src.data_utils import read_reviews
+from src.utils import read_jsonl, read_pickle, setup_logger, write_pickle
+
+logger = logging.getLogger(__name__)
+
+# one per tuple of the text and of the JSON output format
+BLOCK_PATTERN = re.compile(r'#Aspect name:|"a":')
+# `#Review id: <id>` line written before the blocks of each review of a packed prompt
+REVIEW_ID_TOKENS = 8
+
+
+def estimate_tokens(text: str) -> int:
+    # same ~4 characters per token estimate as `extract.estimate_tokens`
+    return len(text) // 4 + 1
+
+
+def length_bin(n_tokens: int) -> int:
+    return int(math.log2(n_tokens + 1))
+
+
+class OutputLengthPredictor:
+    """
+    Predict the max_tokens an extraction needs from the length of its review.
+    The `quantile` of `#Aspect name` blocks per review length bin times the `quantile` of tokens per block,
+    scaled by `margin`. Responses cut by a too small budget are re-issued with the global max_tokens.
+    """
+
+    def __init__(self, quantile: float = 0.95, margin: float = 1.2, min_tokens: int = 32, min_samples: int = 50) -> None:
+        self.quantile = quantile
+        self.margin = margin
+        self.min_tokens = min_tokens
+        self.min_samples = min_samples
+        self.blocks_per_bin = {}
+        self.default_blocks = 1.0
+        self.tokens_per_block = 0.0
+
+    def fit(self, texts: list[str], responses: list[str]):
+        bins, blocks, block_tokens = [], [], []
+        for text, response in zip(texts, responses):
+            n_blocks = len(BLOCK_PATTERN.findall(response))
+            bins.append(length_bin(estimate_tokens(text)))
+            blocks.append(n_blocks)
+            if n_blocks > 0:
+                block_tokens.append(estimate_tokens(response) / n_blocks)
+        bins, blocks = np.array(bins), np.array(blocks, dtype=np.float64)
+        self.default_blocks = float(np.quantile(blocks, self.quantile)) if len(blocks) else 1.0
+        # sparse bins, usually the very long reviews, fall back to the quantile over all reviews
+        self.blocks_per_bin = {
+            int(b): float(np.quantile(blocks[bins == b], self.quantile))
+            for b in np.unique(bins)
+            if (bins == b).sum() >= self.min_samples
+        }
+        self.tokens_per_block = float(np.quantile(block_tokens, self.quantile)) if block_tokens else 0.0
+
+    def predict(self, text: str, max_tokens: int) -> int:
+        """Budget of one review, never above the global `max_tokens`"""
+        if self.tokens_per_block <= 0:
+            return max_tokens
+        n_blocks = max(self.blocks_per_bin.get(length_bin(estimate_tokens(text)), self.default_blocks), 1.0)
+        budget = int(math.ceil(self.margin * n_blocks * self.tokens_per_block))
+        return min(max(budget, self.min_tokens), max_tokens)
+
+    def predict_group(self, texts: list[str], max_tokens: int) -> int:
+        """Budget of a packed prompt, `max_tokens` is per review"""
+        if len(texts) == 1:
+            return self.predict(texts[0], max_tokens)
+        return sum(self.predict(t, max_tokens) + REVIEW_ID_TOKENS for t in texts)
+
+    def save(self, path):
+        # plain state, an instance pickled under `python -m` would reference `__main__`
+        write_pickle(dict(vars(self)), path)
+
+    @classmethod
+    def load(cls, path) -> "OutputLengthPredictor":
+        model = cls()
+        vars(model).update(read_pickle(path))
+        return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the max_tokens predictor on existing extraction outputs.")
+    parser.add_argument("--log_file", type=str, default=None)
+    parser.add_argument("--dataset", type=str, default="amasum")
+    parser.add_argument("--input_path", type=str, default=None, help="Raw extraction output of `extract.py`")
+    parser.add_argument("--output_path", type=str, default=None, help="Pickle file of the fitted predictor")
+    parser.add_argument("--quantile", type=float, default=0.95)
+    parser.add_argument("--margin", type=float, default=1.2)
+    parser.add_argument("--val_ratio", type=float, default=0.1)
+    args = parser.parse_args()
+    cfg.update(args)
+
+    global logger
+    logger = setup_logger(file=args.log_file)
+
+    dataset_name = args.dataset
+    reviews = read_reviews(path=cfg.DATA_CONF[dataset_name]["test_path"], dataset_name=dataset_name)
+    texts = {(r["entity_id"], r["review_id"]): r["review_text"] for r in reviews}
+
+    # copied and prefiltered outputs were never generated, they say nothing about generation length
+    samples = [
+        (texts[(r["entity_id"], r["review_id"])], r["response"])
+        for r in read_jsonl(args.input_path)
+        if not r.get("prefiltered") and not r.get("duplicate_of") and (r["entity_id"], r["review_id"]) in texts
+    ]
+    random.Random(42).shuffle(samples)
+    n_val = int(len(samples) * args.val_ratio)
+    train, val = samples[n_val:], samples[:n_val]
+
+    model = OutputLengthPredictor(quantile=args.quantile, margin=args.margin)
+    model.fit([t for t, _ in train], [r for _, r in train])
+    logger.info(f"Fitted on {len(train)} reviews: {model.tokens_per_block:.1f} tokens per block, blocks per bin {model.blocks_per_bin}")
+
+    max_tokens = cfg.CONF["extraction"]["max_tokens"]
+    budgets = [model.predict(t, max_tokens) for t, _ in val]
+    n_truncated = sum(1 for b, (_, r) in zip(budgets, val) if estimate_tokens(r) > b)
+    logger.info(
+        f"Val: mean budget {np.mean(budgets) if budgets else 0:.0f} vs max_tokens {max_tokens}, "
+        f"{n_truncated}/{len(val)} responses would be re-issued"
+    )
+    model.save(args.output_path)
+
+
+if __name__ == "__main__":
+    main()
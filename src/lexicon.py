@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import pickle
+import re
+from pathlib import Path
+import yaml
+
+logger = logging.getLogger(__name__)
+
+LEXICON_PATH = Path(__file__).with_name("aspect_lexicon.yml")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+
+
+def lemmatize(word: str) -> str:
+    """Crude plural to singular, applied the same way to the lexicon and to the matched text"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("sses", "shes", "ches", "xes")):
+        return word[:-2]
+    if len(word) > 2 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize(text: str) -> list[str]:
+    return [lemmatize(w) for w in TOKEN_PATTERN.findall(text.lower())]
+
+
+class AspectLexicon:
+    """
+    Aspects of a dataset with their synonyms, compiled into an Aho-Corasick automaton over lemmas,
+    so matching an aspect name costs one pass over its words whatever the size of the lexicon.
+    The longest synonym found wins, the rightmost one on ties (the head noun, e.g. "hotel staff").
+    """
+
+    def __init__(self, aspects: dict[str, list[str]], default: str = "general") -> None:
+        self.aspects = list(aspects)
+        if default not in self.aspects:
+            self.aspects.insert(0, default)
+        self.default = default
+        # node -> {lemma: child}, longest suffix node, (length, aspect) of the longest synonym ending there
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]
+        for aspect, synonyms in aspects.items():
+            for synonym in [aspect, *(synonyms or [])]:
+                self._add(normalize(synonym), aspect)
+        self._build()
+
+    def _add(self, lemmas: list[str], aspect: str):
+        if not lemmas:
+            return
+        node = 0
+        for lemma in lemmas:
+            if lemma not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(None)
+                self.goto[node][lemma] = len(self.goto) - 1
+            node = self.goto[node][lemma]
+        if self.out[node] is None:
+            self.out[node] = (len(lemmas), aspect)
+        elif self.out[node][1] != aspect:
+            logger.warning(f"Synonym `{' '.join(lemmas)}` of `{aspect}` is already one of `{self.out[node][1]}`")
+
+    def _build(self):
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for lemma, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and lemma not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(lemma, 0) if node else 0
+                # a synonym ending here is longer than any ending at the suffix node
+                if self.out[child] is None:
+                    self.out[child] = self.out[self.fail[child]]
+                queue.append(child)
+
+    def match(self, text: str) -> str | None:
+        """Aspect of the best synonym found in `text`, None if there is none"""
+        node, best = 0, None
+        for lemma in normalize(text):
+            while node and lemma not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(lemma, 0)
+            found = self.out[node]
+            if found is not None and (best is None or found[0] >= best[0]):
+                best = found
+        return best[1] if best is not None else None
+
+    def get_aspect(self, text: str) -> str:
+        return self.match(text) or self.default
+
+
+_LEXICONS = {}
+
+
+def load_lexicon(dataset_name: str, path=None) -> AspectLexicon:
+    """
+    Lexicon of a dataset, compiled once per process. The compiled automata are also pickled in the
+    `__pycache__` next to the YAML file, keyed by its content and the source of this module, so later runs
+    skip the compilation and a change of the normalization or of the automaton layout invalidates them.
+    """
+    path = Path(path or LEXICON_PATH)
+    if path not in _LEXICONS:
+        _LEXICONS[path] = _load_compiled(path)
+    if dataset_name not in _LEXICONS[path]:
+        raise ValueError(f"Dataset `{dataset_name}` is not in the aspect lexicon `{path}`")
+    return _LEXICONS[path][dataset_name]
+
+
+def _load_compiled(path: Path) -> dict[str, AspectLexicon]:
+    content = path.read_bytes()
+    digest = hashlib.sha256(content + Path(__file__).read_bytes()).hexdigest()[:16]
+    cache_path = path.parent / "__pycache__" / f"{path.stem}.{digest}.pkl"
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Ignore unreadable lexicon cache `{cache_path}`: {e}")
+
+    config = yaml.safe_load(content)
+    lexicons = {
+        dataset_name: AspectLexicon(conf.get("aspects", {}), default=conf.get("default", "general"))
+        for dataset_name, conf in config.items()
+    }
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump(lexicons, f)
+        # automata of older versions of the YAML file or of this module
+        for stale_path in cache_path.parent.glob(f"{path.stem}.*.pkl"):
+            if stale_path != cache_path:
+                stale_path.unlink(missing_ok=True)
+    except OSError as e:
+        logger.debug(f"Cannot cache the compiled lexicon: {e}")
+    return lexicons
@@ -1,33 +1,31 @@
 import argparse
+import json
 # from nltk.stem import PorterStemmer
 # from nltk.corpus import stopwords
 # from nltk.tokenize import word_tokenize
 import logging
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
-from src.utils import read_jsonl, setup_logger, write_jsonl
+from src.lexicon import load_lexicon
+from src.utils import read_jsonl, iter_jsonl, prepare_file, read_jsonl_chunk, setup_logger, write_jsonl
 
 logger = logging.getLogger(__name__)
 
 
-ASPECTS_SPACE = ["general", "rooms", "location", "service", "cleanliness", "building", "food"]
-ASPECTS_AMASUM = ["general"]
+SKIPPED_WORDS = frozenset(["none", "n/a"])
+# label before the opinion phrases of each dataset's text format
+PHRASES_LABELS = {"space": "Expression phrases", "amasum": "Opinion phrases"}
 
 
 def is_valid(text):
-    skipped_words = set(["none", "n/a"])
     text = text.lower().strip()
-    if text in skipped_words:
-        return False
-    if text.startswith('['):
-        return False
-    if text.startswith('n/a'):
-        return False
-    if text.startswith('-'):
-        return True
+    # a leading '-' is valid, the model lists phrases as bullets
     # if text.startswith('hotel'):
         # return False
-    return True
+    return text not in SKIPPED_WORDS and not text.startswith(('[', 'n/a'))
 
 # def is_valid_amasum(text):
 #     skipped_words = set(["none", "n/a"])
@@ -43,46 +41,20 @@ def is_valid(text):
 #     return True
 
 
-def parse_aspect_space(text):
+def parse_aspect(text, lexicon):
+    """Aspect of the first aspect name in `text`, per the dataset's lexicon in `aspect_lexicon.yml`"""
     text = text.strip().lower()
     if ',' in text:
         text = text.split(',', 1)[0]
-
-    a_room = set(['room', 'bathroom', 'bed', 'beds', 'bath', 'accommodations', 'tv', 
-                  'television', 'accommodation', 'bathrooms', 'bedrooms', 'tvs', 'wifi', 'wi-fi'])
-    a_location = set(['view'])
-    a_service = set(['staff', 'services', 'waiters'])
-    a_cleanliness = set('hygiene')
-    a_building = set(['gym', 'pool', 'amenities', 'buildings']) 
-    a_food = set(['breakfast', 'drink', 'drinks'])
-
     if not is_valid(text):
         return None
-    if text in a_room:
-        return 'rooms'
-    if text in a_location:
-        return 'location'
-    if text in a_service:
-        return 'service'
-    if text in a_cleanliness:
-        return 'cleanliness'
-    if text in a_building:
-        return 'building'
-    if text in a_food:
-        return 'food'
-    if text in ASPECTS_SPACE:
-        return text
-    return 'general'
+    return lexicon.get_aspect(text)
+
+def parse_aspect_space(text):
+    return parse_aspect(text, load_lexicon("space"))
 
 def parse_aspect_amasum(text):
-    text = text.strip().lower()
-    if ',' in text:
-        text = text.split(',', 1)[0]
-    if not is_valid(text):
-        return None
-    if text in ASPECTS_AMASUM:
-        return text
-    return 'general'
+    return parse_aspect(text, load_lexicon("amasum"))
 
 def parse_feature(text):
     features = []
@@ -93,12 +65,101 @@ def parse_feature(text):
     return features
 
 def parse_opinion(text):
-    opinions = []
-    for o in text.lower().split(','):
-        o = o.strip()
-        if is_valid(o):
-            opinions.append(o)
-    return opinions
+    opinions = (o.strip() for o in text.lower().split(','))
+    return [o for o in opinions if is_valid(o)]
+
+
+def build_metadata(aspect_text, feature_text, opinion_text, description_text, parse_aspect):
+    """Validate the four fields of a tuple, None if one of them is missing or invalid"""
+    aspect = parse_aspect(aspect_text)
+    feature = feature_text.lower().strip() if is_valid(feature_text) else None
+    opinion = parse_opinion(opinion_text)
+    description = description_text if is_valid(description_text) else None
+
+    # validate data
+    if aspect is None or feature is None or len(opinion) == 0 or description is None:
+        return None
+
+    if feature not in description.lower():
+        aspect = ['general']
+    return {'aspect': aspect, 'feature': feature, 'opinions': opinion, 'description': description}
+
+
+class ResponseParser:
+    """
+    Single-pass parser of the text format: one scan over the `#<label>:` markers of a response splits it
+    into blocks and fields, instead of splitting on `#Aspect name:` and running a regex per block.
+    A block takes the first `#Entity name:`, phrases and `#Description:` markers after its `#Aspect name:`,
+    in that order; later or out of order markers are part of the field text.
+    SPACE fields are single-line and its description stops at the end of its line, as the former
+    non-DOTALL regex did, AMASUM descriptions run up to the next block.
+    """
+
+    def __init__(self, dataset_name):
+        if dataset_name not in PHRASES_LABELS:
+            raise ValueError()
+        self.labels = ("Aspect name", "Entity name", PHRASES_LABELS[dataset_name], "Description")
+        # one group per label, `lastindex` tells which one matched
+        self.label_pattern = re.compile("#(?:" + "|".join(f"({label})" for label in self.labels) + "):")
+        self.multiline = dataset_name == "amasum"
+        # rare fallback of single-line blocks, see `_parse_fields`
+        self.block_pattern = re.compile(
+            r'#Aspect name:\s*(.*?)\s*#Entity name:\s*(.*?)\s*#%s:\s*(.*?)\s*#Description:\s*(.*)' % self.labels[2]
+        )
+        self.parse_aspect = get_parse_aspect_function(dataset_name)
+
+    def iter_blocks(self, text):
+        """Yield the metadata of every block, None for an invalid block"""
+        marks = []
+        for m in self.label_pattern.finditer(text):
+            i = m.lastindex - 1
+            if i == 0:
+                if marks:
+                    yield self._parse_fields(text, marks, m.start())
+                marks = [m.span()]
+            elif i == len(marks):
+                marks.append(m.span())
+        if marks:
+            yield self._parse_fields(text, marks, len(text))
+
+    def _parse_fields(self, text, marks, end):
+        if len(marks) < 4:
+            return None
+        fields = [text[marks[i][1]:marks[i + 1][0]].strip() for i in range(3)]
+        description = text[marks[3][1]:end].strip()
+        if not self.multiline:
+            if any('\n' in f for f in fields):
+                # a field spanning lines may still match with a later marker inside a field, leave it to the regex
+                match = self.block_pattern.match(text[marks[0][0]:end].strip())
+                return build_metadata(*match.groups(), self.parse_aspect) if match else None
+            description = description.split('\n', 1)[0]
+        return build_metadata(*fields, description, self.parse_aspect)
+
+    def parse_block(self, text):
+        """Metadata of the first block of `text`, None if it is invalid or missing"""
+        for metadata in self.iter_blocks(text):
+            return metadata
+        return None
+
+    def parse(self, response):
+        """Return the valid blocks of a response and its number of invalid blocks"""
+        data, cnt_invalid = [], 0
+        for metadata in self.iter_blocks(response):
+            if metadata:
+                data.append(metadata)
+            else:
+                cnt_invalid += 1
+        return data, cnt_invalid
+
+
+_PARSERS = {}
+
+
+def get_response_parser(dataset_name) -> ResponseParser:
+    if dataset_name not in _PARSERS:
+        _PARSERS[dataset_name] = ResponseParser(dataset_name)
+    return _PARSERS[dataset_name]
+
 
 def parse_sentence_space(text):
     """
@@ -106,30 +167,7 @@ def parse_sentence_space(text):
     
     Extract Aspect, Feature, Opinion, Description from the text
     """
-    pattern = r'#Aspect name:\s*(.*?)\s*#Entity name:\s*(.*?)\s*#Expression phrases:\s*(.*?)\s*#Description:\s*(.*)'  
-    # matches = re.findall(pattern, text, re.DOTALL)
-    matches = re.findall(pattern, text)
-    metadata = {}
-    if matches:
-        aspect_text, feature_text, opinion_text, description_text = matches[0]
-
-        aspect = parse_aspect_space(aspect_text)
-        feature = feature_text.lower().strip() if is_valid(feature_text) else None
-        opinion = parse_opinion(opinion_text)
-        description = description_text if is_valid(description_text) else None
-
-        # validate data 
-        if aspect is None or feature is None or len(opinion) == 0 or description is None:
-            return None
-
-        if feature not in description.lower():
-            aspect = ['general']
-        metadata['aspect'] = aspect
-        metadata['feature'] = feature
-        metadata['opinions'] = opinion
-        metadata['description'] = description
-
-    return metadata
+    return get_response_parser("space").parse_block(text)
 
 def parse_sentence_amasum(text):
     """ 
@@ -137,97 +175,252 @@ def parse_sentence_amasum(text):
 
     Extract Aspect, Feature, Opinion, Description from the text
     """
-    pattern = r'#Aspect name:\s*(.*?)\s*#Entity name:\s*(.*?)\s*#Opinion phrases:\s*(.*?)\s*#Description:\s*(.*)'  
-    matches = re.findall(pattern, text, re.DOTALL)
-    # matches = re.findall(pattern, text)
-    metadata = {}
-    if matches:
-        aspect_text, feature_text, opinion_text, description_text = matches[0]
-
-        aspect = parse_aspect_amasum(aspect_text)
-        feature = feature_text.lower().strip() if is_valid(feature_text) else None
-        opinion = parse_opinion(opinion_text)
-        description = description_text if is_valid(description_text) else None
-
-        # validate data 
-        if aspect is None or feature is None or len(opinion) == 0 or description is None:
-            return None
+    return get_response_parser("amasum").parse_block(text)
+
 
-        if feature not in description.lower():
-            aspect = ['general']
-        metadata['aspect'] = aspect
-        metadata['feature'] = feature
-        metadata['opinions'] = opinion
-        metadata['description'] = description
+def parse_tuple_json(item, parse_aspect):
+    """
+    example item: {"a": "Location", "e": "Hotel Navona", "o": ["perfect", "beautiful"], "d": "The Hotel Navona is situated in perfect location."}
 
-    return metadata
+    Same validation as `parse_sentence_space`/`parse_sentence_amasum` on a tuple of the JSON output format
+    """
+    if not isinstance(item, dict):
+        return None
+    opinions = item.get("o", [])
+    opinion_text = ", ".join(str(o) for o in opinions) if isinstance(opinions, list) else str(opinions)
+    return build_metadata(str(item.get("a", "")), str(item.get("e", "")), opinion_text, str(item.get("d", "")), parse_aspect)
 
 
-def parse_extraction_output(file_path, dataset_name):
-    parse_function = None
+def get_parse_aspect_function(dataset_name):
+    # datasets only need an entry in the lexicon
+    return partial(parse_aspect, lexicon=load_lexicon(dataset_name))
+
+
+def get_parse_function(dataset_name):
     if dataset_name == 'space':
-        parse_function = parse_sentence_space 
+        return parse_sentence_space
     elif dataset_name == "amasum":
-        parse_function = parse_sentence_amasum
+        return parse_sentence_amasum
     else:
         raise ValueError()
 
-    reviews = read_jsonl(file_path)   
-    # ps = nltk.stem.porter.PorterStemmer() # stemming e.g. ps.stem('words')
-    
-    parsed_reviews = []
-    cnt_invalid = 0
-    cnt_empty = 0
-    for review in tqdm(reviews, desc="Parsing reviews", ncols=0):
-        obj = { 
-            "entity_id": review['entity_id'],
-            "review_id": review['review_id'],
-        }
-        # Find all positions of occurrence of the text '#Aspect name:' in review['response']
-        positions = [m.start() for m in re.finditer(r'#Aspect name:', review['response'])]
-        positions.append(len(review['response']))
-        sentences = [ review['response'][positions[i]: positions[i+1]].strip() for i in range(len(positions)-1)]
-        sentence_data = []
-        cnt_invalid_sent = 0
-        for sentence in sentences:
-            metadata = parse_function(sentence)
-            if metadata:
-                sentence_data.append(metadata)
-            else:
-                cnt_invalid_sent += 1
-                # print(review['response'])
-                # if "Aspect" in sentence and "Entity" in sentence \
-                #     and "Opinion" in sentence and "Description" in sentence:
-                #     print(f"Enity ID: {review['entity_id']}, Review ID: {review['review_id']}:\n{sentence}")
-        obj['data'] = sentence_data
-        # if len(sentence_data) == 0:
-        #     sentences = [r.strip() for r in review['response'].split("\n") if r.strip().startswith('#')]
-        #     sentence_data = []
-        #     cnt_invalid_sent = 0
-        #     for sentence in sentences:
-        #         metadata = parse_function(sentence)
-        #         if metadata:
-        #             sentence_data.append(metadata)
-        #         else:
-        #             cnt_invalid_sent += 1
-        #             # print(review['response'])
-        #             if "Aspect" in sentence and "Feature" in sentence \
-        #                 and "Opinion" in sentence and "Description" in sentence:
-        #                 print(f"Enity ID: {review['entity_id']}, Review ID: {review['review_id']}:\n{sentence}")
-        #     obj['data'] = sentence_data
-        cnt_invalid += cnt_invalid_sent
+
+def parse_review_json(review, parse_aspect):
+    """Parse a response of the JSON output format, an unreadable (e.g. truncated) one counts as one invalid sentence"""
+    obj = {
+        "entity_id": review['entity_id'],
+        "review_id": review['review_id'],
+        "data": [],
+    }
+    try:
+        items = json.loads(review['response'])["t"]
+    except (ValueError, KeyError, TypeError):
+        return obj, 1
+    if not isinstance(items, list):
+        return obj, 1
+    cnt_invalid_sent = 0
+    for item in items:
+        metadata = parse_tuple_json(item, parse_aspect)
+        if metadata:
+            obj['data'].append(metadata)
+        else:
+            cnt_invalid_sent += 1
+    return obj, cnt_invalid_sent
+
+
+def parse_review(review, parser):
+    """Parse one extraction response, return the parsed review and its number of invalid sentences"""
+    # responses of `extract.py --output_format json`
+    if review['response'].lstrip().startswith('{'):
+        return parse_review_json(review, parser.parse_aspect)
+    obj = {
+        "entity_id": review['entity_id'],
+        "review_id": review['review_id'],
+    }
+    obj['data'], cnt_invalid_sent = parser.parse(review['response'])
+    return obj, cnt_invalid_sent
+
+
+class ExtractionStreamGuard:
+    """
+    Incremental parser of a streamed extraction response, text or JSON format.
+    `feed` returns False once the generation degenerates: a tuple repeating an earlier one, `max_invalid`
+    invalid tuples in a row, or a tuple/preamble too long to be real. `result` then keeps the tuples before it.
+    """
+
+    MARKER = '#Aspect name:'
+
+    def __init__(self, dataset_name, max_invalid=3, max_block_chars=2000, max_preamble_chars=1000):
+        self.parser = get_response_parser(dataset_name)
+        self.max_invalid = max_invalid
+        self.max_block_chars = max_block_chars
+        self.max_preamble_chars = max_preamble_chars
+        self.text = ""
+        self.stopped = False
+        self.seen = set()
+        self.n_invalid = 0
+        # text format: start of every block found so far, end of the blocks kept
+        self.starts = []
+        self.n_checked = 0
+        self.kept_end = 0
+        # json format: position of the next item and the items kept
+        self.pos = None
+        self.items = []
+
+    def feed(self, delta: str) -> bool:
+        if self.stopped:
+            return False
+        self.text += delta
+        if self.text.lstrip().startswith('{'):
+            self._feed_json()
+        else:
+            self._feed_text(len(delta))
+        return not self.stopped
+
+    def _check(self, key, valid) -> bool:
+        """Track a complete tuple, return False when the generation must stop"""
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        self.n_invalid = 0 if valid else self.n_invalid + 1
+        return self.n_invalid < self.max_invalid
+
+    def _feed_text(self, n_new):
+        # the marker may be split across chunks, but one found by the previous feed is not found again
+        pos = max(0, len(self.text) - n_new - len(self.MARKER))
+        if self.starts:
+            pos = max(pos, self.starts[-1] + len(self.MARKER))
+        while (pos := self.text.find(self.MARKER, pos)) != -1:
+            self.starts.append(pos)
+            pos += len(self.MARKER)
+        # a block is complete once the next one starts
+        while self.n_checked + 1 < len(self.starts):
+            start, end = self.starts[self.n_checked], self.starts[self.n_checked + 1]
+            block = self.text[start:end].strip()
+            if not self._check(" ".join(block.lower().split()), bool(self.parser.parse_block(block))):
+                self.stopped = True
+                return
+            self.n_checked += 1
+            # a run of invalid blocks is dropped when it ends the kept output
+            if self.n_invalid == 0:
+                self.kept_end = end
+        if not self.starts:
+            self.stopped = len(self.text) > self.max_preamble_chars
+        else:
+            self.stopped = len(self.text) - self.starts[-1] > self.max_block_chars
+
+    def _feed_json(self):
+        decoder = json.JSONDecoder()
+        if self.pos is None:
+            start = self.text.find('[')
+            if start == -1:
+                self.stopped = len(self.text) > self.max_preamble_chars
+                return
+            self.pos = start + 1
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in ' \t\n\r,':
+                self.pos += 1
+            if self.pos >= len(self.text) or self.text[self.pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                # not complete yet
+                self.stopped = len(self.text) - self.pos > self.max_block_chars
+                return
+            metadata = parse_tuple_json(item, self.parser.parse_aspect)
+            if not self._check(json.dumps(item, sort_keys=True), bool(metadata)):
+                self.stopped = True
+                return
+            self.items.append((item, bool(metadata)))
+            self.pos = end
+
+    def result(self) -> str:
+        """The whole response, or the tuples kept before the stream was stopped"""
+        if not self.stopped:
+            return self.text.strip()
+        if self.pos is not None:
+            n_kept = len(self.items)
+            # drop the trailing run of invalid items
+            while n_kept > 0 and not self.items[n_kept - 1][1]:
+                n_kept -= 1
+            items = [item for item, _ in self.items[:n_kept]]
+            return json.dumps({"t": items}, ensure_ascii=False, separators=(',', ':'))
+        return self.text[: self.kept_end].strip()
+
+
+def iter_parsed_reviews(reviews, dataset_name, stats=None):
+    """
+    Lazily parse extraction responses, skipping reviews with no valid sentences.
+    `stats` is updated in place with `cnt_invalid` and `cnt_empty`.
+    """
+    parser = get_response_parser(dataset_name)
+    if stats is None:
+        stats = {}
+    stats.setdefault("cnt_invalid", 0)
+    stats.setdefault("cnt_empty", 0)
+    for review in reviews:
+        obj, cnt_invalid_sent = parse_review(review, parser)
+        stats["cnt_invalid"] += cnt_invalid_sent
         if len(obj['data']) == 0:
-            cnt_empty += 1
+            stats["cnt_empty"] += 1
             # if "Aspect" in review['response'] and "Entity" in review['response'] \
             #     and "Opinion" in review['response'] and "Description" in review['response']:
             #     print(f"Enity ID: {review['entity_id']}, Review ID: {review['review_id']}:\n{review['response']}")
         else:
-            parsed_reviews.append(obj)
-    logger.info(f"Discarded {cnt_invalid} invalid sentences")
-    logger.info(f"Found {cnt_empty} parsed reviews with no valid sentences")
+            yield obj
+
+
+def parse_extraction_output(file_path, dataset_name):
+    reviews = read_jsonl(file_path)   
+    # ps = nltk.stem.porter.PorterStemmer() # stemming e.g. ps.stem('words')
+
+    stats = {}
+    parsed_reviews = list(
+        iter_parsed_reviews(tqdm(reviews, desc="Parsing reviews", ncols=0), dataset_name, stats=stats)
+    )
+    logger.info(f"Discarded {stats['cnt_invalid']} invalid sentences")
+    logger.info(f"Found {stats['cnt_empty']} parsed reviews with no valid sentences")
     return parsed_reviews
         
 
+def _parse_lines(lines, dataset_name):
+    """Worker of `parse_extraction_file`: decode, parse and encode a chunk of raw lines"""
+    stats = {}
+    parsed = iter_parsed_reviews((json.loads(line) for line in lines), dataset_name, stats=stats)
+    text = "".join(json.dumps(obj) + "\n" for obj in parsed)
+    return text, stats["cnt_invalid"], stats["cnt_empty"]
+
+
+def parse_extraction_file(input_path, output_path, dataset_name, num_workers=4, chunk_size=10000):
+    """
+    Parse a raw extraction file with `num_workers` processes, streaming chunks of `chunk_size` lines.
+    Results are written in input order and at most 2 chunks per worker are in flight, memory stays bounded.
+    """
+    stats = {"cnt_invalid": 0, "cnt_empty": 0}
+    n_written = 0
+    prepare_file(output_path)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, open(output_path, 'w') as f:
+
+        def write(future):
+            nonlocal n_written
+            text, cnt_invalid, cnt_empty = future.result()
+            f.write(text)
+            n_written += text.count("\n")
+            stats["cnt_invalid"] += cnt_invalid
+            stats["cnt_empty"] += cnt_empty
+
+        pending = deque()
+        for lines in read_jsonl_chunk(input_path, chunk_size=chunk_size, decode=False):
+            pending.append(executor.submit(_parse_lines, lines, dataset_name))
+            if len(pending) >= 2 * num_workers:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    logger.info(f"Saved {n_written} lines to `{output_path}`")
+    return stats
+
+
 def main():
     parser = argparse.ArgumentParser(description="Updating Config settings.")
     parser.add_argument(
@@ -237,14 +430,30 @@ def main():
     parser.add_argument("--input_path", type=str, default=None)
     parser.add_argument("--dataset", type=str, default="amasum")
     parser.add_argument("--output_path", type=str, default=None)
+    parser.add_argument("--stream", action="store_true", default=False, help="Parse line by line in constant memory")
+    parser.add_argument("--num_workers", type=int, default=0, help="Parse chunks of the file in worker processes")
+    parser.add_argument("--chunk_size", type=int, default=10000)
     args = parser.parse_args()
 
     # setup logger
     global logger
     logger = setup_logger(file=args.log_file, level=args.log_level)
 
-    parsed_reviews = parse_extraction_output(args.input_path, args.dataset)
-    write_jsonl(parsed_reviews, args.output_path)
+    if args.num_workers > 0:
+        stats = parse_extraction_file(
+            args.input_path, args.output_path, args.dataset, num_workers=args.num_workers, chunk_size=args.chunk_size
+        )
+        logger.info(f"Discarded {stats['cnt_invalid']} invalid sentences")
+        logger.info(f"Found {stats['cnt_empty']} parsed reviews with no valid sentences")
+    elif args.stream:
+        stats = {}
+        reviews = iter_jsonl(args.input_path)
+        write_jsonl(iter_parsed_reviews(reviews, args.dataset, stats=stats), args.output_path, verbose=False)
+        logger.info(f"Discarded {stats['cnt_invalid']} invalid sentences")
+        logger.info(f"Found {stats['cnt_empty']} parsed reviews with no valid sentences")
+    else:
+        parsed_reviews = parse_extraction_output(args.input_path, args.dataset)
+        write_jsonl(parsed_reviews, args.output_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import logging
+from tqdm import tqdm
+from src import prompt_template
+from src.config import cfg
+from src.data_utils import iter_data
+from src.extract import get_messages, write_output
+from src.journal import Journal
+from src.parse import iter_parsed_reviews
+from src.push_graph import Editor, get_driver, get_processed_entities, group_by_entity, push_data
+from src.call_llm.cache import ResponseCache
+from src.utils import setup_logger
+
+logger = logging.getLogger(__name__)
+
+
+def iter_windows(entities, max_reviews):
+    """Group consecutive entities until they hold `max_reviews` reviews, a large entity makes its own window"""
+    window, n_reviews = [], 0
+    for entity in entities:
+        if window and n_reviews + len(entity["reviews"]) > max_reviews:
+            yield window
+            window, n_reviews = [], 0
+        window.append(entity)
+        n_reviews += len(entity["reviews"])
+    if window:
+        yield window
+
+
+async def generate_concurrently(model, messages_list, sampling_params, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(messages):
+        async with semaphore:
+            return await model.agenerate(messages, sampling_params)
+
+    return await asyncio.gather(*[run(messages) for messages in messages_list])
+
+
+def iter_extracted(windows, generate_fn, extraction_prompt):
+    """Extraction stage: yield the raw responses of each window, one record per review"""
+    for window in windows:
+        reviews = [{"entity_id": e["entity_id"], **r} for e in window for r in e["reviews"]]
+        responses = generate_fn(get_messages([r["review_text"] for r in reviews], extraction_prompt))
+        yield [
+            {"entity_id": r["entity_id"], "review_id": r["review_id"], "response": response.strip()}
+            for r, response in zip(reviews, responses)
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract, parse and push to the graph one entity window at a time.")
+    parser.add_argument("--log_file", type=str, default=None)
+    parser.add_argument("--model_name", type=str, default="mistral")
+    parser.add_argument("--dataset", type=str, default="amasum")
+    parser.add_argument("--exp_name", type=str, default="amasum_mistral")
+    parser.add_argument("--output_path", type=str, default=None, help="Raw extraction responses, kept for reference")
+    parser.add_argument("--journal_path", type=str, default=None, help="Resume journal, default `<output_path>.journal`")
+    parser.add_argument("--window_size", type=int, default=256, help="Reviews generated together, bounds memory")
+    parser.add_argument("--concurrency", type=int, default=16, help="Max in-flight GPT requests")
+    parser.add_argument("--cache_path", type=str, default=None, help="SQLite file to cache LLM responses")
+    parser.add_argument("--cache_max_size_mb", type=float, default=0, help="Evict cached responses above this size")
+    args = parser.parse_args()
+    cfg.update(args)
+
+    global logger
+    logger = setup_logger(file=cfg.CONF["log_file"])
+    logger.info(cfg)
+
+    dataset_name = cfg.CONF["dataset"]
+    exp_name = cfg.CONF["exp_name"]
+    output_path = cfg.CONF["output_path"]
+    extraction_prompt = prompt_template.PROMPT_EXTRACTION[dataset_name].strip()
+
+    cache = None
+    if cfg.CONF["cache_path"]:
+        cache = ResponseCache(cfg.CONF["cache_path"], max_size_mb=cfg.CONF["cache_max_size_mb"])
+
+    loop = None
+    if "gpt" in cfg.CONF["model_name"]:
+        logger.info("Generate by GPT")
+        from src.call_llm.gpt import GPT
+
+        model = GPT(**cfg.OPENAI_CONF[cfg.CONF["model_name"]], cache=cache)
+        sampling_params = {
+            "max_tokens": cfg.CONF['extraction']["max_tokens"],
+            "temperature": cfg.CONF['extraction']["temperature"],
+            "top_p": cfg.CONF['extraction']["top_p"],
+        }
+
+        # one loop for the whole run, the connections of the async client are bound to the loop that opened them
+        loop = asyncio.new_event_loop()
+
+        def generate_fn(messages_list):
+            return loop.run_until_complete(
+                generate_concurrently(model, messages_list, sampling_params, cfg.CONF["concurrency"])
+            )
+    else:
+        logger.info("Generate by vLLM")
+        from vllm import SamplingParams
+        from src.call_llm.vllm_model import VLLMModel
+
+        sampling_params = SamplingParams(
+            max_tokens=cfg.CONF['extraction']["max_tokens"],
+            temperature=cfg.CONF['extraction']["temperature"],
+            top_p=cfg.CONF['extraction']["top_p"],
+            top_k=cfg.CONF['extraction']["top_k"],
+        )
+        model_config = cfg.HF_CONF["mistral"]
+        model = VLLMModel(
+            model_config["model_path"],
+            cache=cache,
+            swap_space=4,
+            dtype=model_config["dtype"],
+            seed=42,
+            gpu_memory_utilization=0.9,
+        )
+
+        def generate_fn(messages_list):
+            return model.batch_generate(messages_list, sampling_params=sampling_params)
+
+    driver = get_driver(**cfg.DB_CONF["neo4j"])
+    # an entity is done once pushed, the database catches a crash between push and journal
+    journal = Journal(cfg.CONF["journal_path"] or f"{output_path}.journal")
+    processed_entities = get_processed_entities(exp_name, driver)
+    logger.info(f"Found {len(processed_entities)} entities in the database.")
+
+    # Stages are generators, only the current window is held in memory
+    entities = iter_data(cfg.DATA_CONF[dataset_name]["test_path"], dataset_name)
+    entities = (
+        e for e in entities if e["entity_id"] not in processed_entities and Journal.key(e["entity_id"]) not in journal
+    )
+    editor = Editor()
+    stats = {}
+    p_bar = tqdm(desc="Entities", ncols=0)
+    for records in iter_extracted(iter_windows(entities, cfg.CONF["window_size"]), generate_fn, extraction_prompt):
+        # a blank response is a failed request, its entity is neither pushed nor journaled and is redone next run
+        failed = set(r["entity_id"] for r in records if not r["response"])
+        if failed:
+            logger.warning(f"Skip {len(failed)} entities with failed requests, they are retried on the next run")
+            records = [r for r in records if r["entity_id"] not in failed]
+        for entity_id, entity_data in group_by_entity(iter_parsed_reviews(records, dataset_name, stats=stats)):
+            push_data(entity_id, entity_data, editor, driver, exp_name=exp_name, dataset_name=dataset_name)
+        write_output(records, [r["response"] for r in records], output_path, verbose=False)
+        # entities without any valid sentence are journaled too, they are never pushed
+        entity_ids = list(dict.fromkeys(r["entity_id"] for r in records))
+        journal.extend([Journal.key(entity_id) for entity_id in entity_ids])
+        p_bar.update(len(entity_ids))
+    p_bar.close()
+    logger.info(f"Discarded {stats.get('cnt_invalid', 0)} invalid sentences")
+    logger.info(f"Found {stats.get('cnt_empty', 0)} parsed reviews with no valid sentences")
+
+    journal.close()
+    driver.close()
+    if loop is not None:
+        loop.close()
+    if cache is not None:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
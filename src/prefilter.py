@@ -0,0 +1,142 @@
+import argparse
+import logging
+import math
+import random
+import re
+import zlib
+import numpy as np
+from src.config import cfg
+from src.data_utils import read_reviews, ASPECTS_SPACE
+from src.parse import parse_extraction_output
+from src.utils import read_jsonl, read_pickle, setup_logger, write_pickle
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+ASPECT_WORDS = set(ASPECTS_SPACE)
+
+
+class ReviewPrefilter:
+    """
+    Hashed bag-of-words logistic regression predicting whether a review yields any valid extraction tuple.
+    Scores of held-out positive reviews are kept so the recall target can be changed without retraining.
+    """
+
+    def __init__(self, n_features: int = 1 << 20) -> None:
+        self.n_features = n_features
+        self.weights = np.zeros(n_features, dtype=np.float32)
+        self.bias = 0.0
+        self.positive_scores = np.zeros(0, dtype=np.float64)
+
+    def featurize(self, text: str) -> list[int]:
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        features.append(f"len:{int(math.log2(len(tokens) + 1))}")
+        if any(t in ASPECT_WORDS for t in tokens):
+            features.append("aspect_word")
+        return list(set(zlib.crc32(f.encode("utf-8")) % self.n_features for f in features))
+
+    def score(self, text: str) -> float:
+        z = self.bias + float(self.weights[self.featurize(text)].sum())
+        return 1.0 / (1.0 + math.exp(-max(min(z, 30.0), -30.0)))
+
+    def fit(self, texts: list[str], labels: list[int], epochs: int = 5, lr: float = 0.1, l2: float = 1e-6, seed: int = 42):
+        features = [self.featurize(text) for text in texts]
+        order = list(range(len(texts)))
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            loss = 0.0
+            for i in order:
+                z = self.bias + float(self.weights[features[i]].sum())
+                p = 1.0 / (1.0 + math.exp(-max(min(z, 30.0), -30.0)))
+                grad = p - labels[i]
+                self.weights[features[i]] -= lr * (grad + l2 * self.weights[features[i]])
+                self.bias -= lr * grad
+                loss -= math.log(max(p if labels[i] else 1.0 - p, 1e-12))
+            logger.info(f"Epoch {epoch + 1}: loss {loss / max(len(texts), 1):.4f}")
+
+    def calibrate(self, texts: list[str], labels: list[int]):
+        self.positive_scores = np.sort(np.array([self.score(t) for t, y in zip(texts, labels) if y], dtype=np.float64))
+
+    def threshold(self, recall: float) -> float:
+        """Highest score threshold keeping at least `recall` of held-out positive reviews"""
+        if len(self.positive_scores) == 0:
+            return 0.0
+        n_missed = int(math.floor((1.0 - recall) * len(self.positive_scores)))
+        return float(self.positive_scores[min(n_missed, len(self.positive_scores) - 1)])
+
+    def save(self, path):
+        # plain state, an instance pickled under `python -m` would reference `__main__`
+        state = {"n_features": self.n_features, "weights": self.weights, "bias": self.bias, "positive_scores": self.positive_scores}
+        write_pickle(state, path)
+
+    @classmethod
+    def load(cls, path) -> "ReviewPrefilter":
+        state = read_pickle(path)
+        model = cls(n_features=state["n_features"])
+        model.weights = state["weights"]
+        model.bias = state["bias"]
+        model.positive_scores = state["positive_scores"]
+        return model
+
+    def filter(self, reviews: list[dict], recall: float = 0.99) -> tuple[list[dict], list[dict]]:
+        """Split reviews into (kept, skipped)"""
+        threshold = self.threshold(recall)
+        kept, skipped = [], []
+        for review in reviews:
+            if self.score(review["review_text"]) >= threshold:
+                kept.append(review)
+            else:
+                skipped.append(review)
+        logger.info(
+            f"Prefilter (recall {recall}, threshold {threshold:.4f}): skipped {len(skipped)} of {len(reviews)} reviews, "
+            f"avoided {len(skipped)} extraction calls ({len(skipped) / max(len(reviews), 1):.1%})"
+        )
+        return kept, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the review prefilter on existing extraction outputs.")
+    parser.add_argument("--log_file", type=str, default=None)
+    parser.add_argument("--dataset", type=str, default="amasum")
+    parser.add_argument("--input_path", type=str, default=None, help="Raw extraction output of `extract.py`")
+    parser.add_argument("--output_path", type=str, default=None, help="Pickle file of the trained prefilter")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--val_ratio", type=float, default=0.1)
+    parser.add_argument("--recall", type=float, default=0.99)
+    args = parser.parse_args()
+    cfg.update(args)
+
+    global logger
+    logger = setup_logger(file=args.log_file)
+
+    dataset_name = args.dataset
+    reviews = read_reviews(path=cfg.DATA_CONF[dataset_name]["test_path"], dataset_name=dataset_name)
+    texts = {(r["entity_id"], r["review_id"]): r["review_text"] for r in reviews}
+
+    # a review is positive when the parser keeps at least one tuple of its response
+    # lines skipped by an earlier prefilter were never generated, they carry no label
+    extracted = [(r["entity_id"], r["review_id"]) for r in read_jsonl(args.input_path) if not r.get("prefiltered")]
+    positives = set((r["entity_id"], r["review_id"]) for r in parse_extraction_output(args.input_path, dataset_name))
+    samples = [(texts[key], int(key in positives)) for key in extracted if key in texts]
+    random.Random(42).shuffle(samples)
+    n_val = int(len(samples) * args.val_ratio)
+    train, val = samples[n_val:], samples[:n_val]
+    positive_rate = sum(y for _, y in samples) / max(len(samples), 1)
+    logger.info(f"Train {len(train)}, val {len(val)}, positive rate {positive_rate:.3f}")
+
+    model = ReviewPrefilter()
+    model.fit([t for t, _ in train], [y for _, y in train], epochs=args.epochs)
+    model.calibrate([t for t, _ in val], [y for _, y in val])
+
+    threshold = model.threshold(args.recall)
+    predictions = [model.score(t) >= threshold for t, _ in val]
+    n_skipped = sum(1 for p in predictions if not p)
+    n_missed = sum(1 for p, (_, y) in zip(predictions, val) if y and not p)
+    logger.info(f"Val at recall {args.recall}: skip {n_skipped}/{len(val)} reviews, lose {n_missed} positive reviews")
+    model.save(args.output_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,89 @@ For example:
 ### Review: {reviews}"""
 }
 
+# params: reviews, compact JSON answer, see `EXTRACTION_JSON_SCHEMA`
+PROMPT_EXTRACTION_JSON = {
+    "amasum": """Your task is to extract entities explicitly reviewed (noun), their aspects, and expression phrases (positive or negative adjective) respectively in the following ### Review.
+Answer with a compact JSON object, without spaces between items, whose "t" list holds one item per extraction: "a" aspect names, "e" entity name, "o" opinion phrases, "d" description.
+For example:
+{{"t":[{{"a":"Material, Durability","e":"Boots","o":["excellent","durable"],"d":"My boots are made of excellent leather and very durable."}}]}}
+### Review: {reviews}""",
+    "space": """Your task is to extract entities explicitly reviewed (noun), their aspects (just one in: Rooms, Location, Service, Cleanliness, Building, Food, General), and expression phrases (positive or negative adjective) respectively in the following ### Review.
+Answer with a compact JSON object, without spaces between items, whose "t" list holds one item per extraction: "a" aspect name, "e" entity name, "o" expression phrases, "d" description.
+For example:
+{{"t":[{{"a":"Service","e":"Staff","o":["kind","friendly"],"d":"The staff was kind and friendly."}}]}}
+### Review: {reviews}"""
+}
+
+
+def _extraction_json_schema(aspect_schema):
+    item = {
+        "type": "object",
+        "properties": {
+            "a": aspect_schema,
+            "e": {"type": "string"},
+            "o": {"type": "array", "items": {"type": "string"}},
+            "d": {"type": "string"},
+        },
+        "required": ["a", "e", "o", "d"],
+        "additionalProperties": False,
+    }
+    return {
+        "type": "object",
+        "properties": {"t": {"type": "array", "items": item}},
+        "required": ["t"],
+        "additionalProperties": False,
+    }
+
+
+# constrains decoding of `PROMPT_EXTRACTION_JSON` answers, single letter keys keep the output short
+EXTRACTION_JSON_SCHEMA = {
+    "amasum": _extraction_json_schema({"type": "string"}),
+    "space": _extraction_json_schema(
+        {"type": "string", "enum": ["Rooms", "Location", "Service", "Cleanliness", "Building", "Food", "General"]}
+    ),
+}
+
+# params: reviews, each review is prefixed by `#Review id: <review_id>`
+PROMPT_EXTRACTION_PACKED = {
+    "amasum": """Your task is to extract entities explicitly reviewed (noun), their aspects, and expression phrases (positive or negative adjective) respectively in each of the following ### Reviews.
+Each review starts with its #Review id. Write the #Review id line first, then the extractions of that review.
+Please follow template:
+#Review id: #Aspect name: #Entity name: #Opinion phrases: #Description:
+For example:
+#Review id: 1
+#Aspect name: Material, Durability #Entity name: Boots #Opinion phrases: excellent, durable #Description: My boots are made of excellent leather and very durable.
+### Reviews:
+{reviews}""",
+    "space": """Your task is to extract entities explicitly reviewed (noun), their aspects (just one in: Rooms, Location, Service, Cleanliness, Building, Food, General), and expression phrases (positive or negative adjective) respectively in each of the following ### Reviews.
+Each review starts with its #Review id. Write the #Review id line first, then the extractions of that review.
+Please follow template:
+#Review id: #Aspect name: #Entity name: #Expression phrases: #Description:
+For example:
+#Review id: 1
+#Aspect name: Service #Entity name: Staff #Expression phrases: kind, friendly #Description: The staff was kind and friendly.
+### Reviews:
+{reviews}"""
+}
+
+# params: reviews, stricter `PROMPT_EXTRACTION` to re-ask the reviews whose extraction failed to parse
+PROMPT_EXTRACTION_REPAIR = {
+    "amasum": """Your task is to extract entities explicitly reviewed (noun), their aspects, and expression phrases (positive or negative adjective) respectively in the following ### Review.
+Write one line per extraction, exactly in this template, with every field filled and nothing else before, between or after the lines:
+#Aspect name: <aspects> #Entity name: <entity> #Opinion phrases: <phrases> #Description: <sentence of the review>
+The entity name must appear in the description. Never repeat an extraction and never write None or N/A in a field.
+For example:
+#Aspect name: Material, Durability #Entity name: Boots #Opinion phrases: excellent, durable #Description: My boots are made of excellent leather and very durable.
+### Review: {reviews}""",
+    "space": """Your task is to extract entities explicitly reviewed (noun), their aspects (just one in: Rooms, Location, Service, Cleanliness, Building, Food, General), and expression phrases (positive or negative adjective) respectively in the following ### Review.
+Write one line per extraction, exactly in this template, with every field filled and nothing else before, between or after the lines:
+#Aspect name: <aspect> #Entity name: <entity> #Expression phrases: <phrases> #Description: <sentence of the review>
+The entity name must appear in the description. Never repeat an extraction and never write None or N/A in a field.
+For example:
+#Aspect name: Service #Entity name: Staff #Expression phrases: kind, friendly #Description: The staff was kind and friendly.
+### Review: {reviews}"""
+}
+
 PROMPT_SUMMARIZATION = """Briefly summarize:
 {knowledge_graph}
 For example:
@@ -1,174 +1,392 @@
 import argparse
-from collections import defaultdict, OrderedDict
+import csv
+import logging
+import os
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from nltk.stem import PorterStemmer
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 from neo4j import GraphDatabase
 from tqdm import tqdm
-from src.utils import read_jsonl, setup_logger
+from src.utils import read_jsonl, iter_jsonl, read_pickle, setup_logger, write_pickle
 from src.config import cfg
+from src.graph_schema import check_query_plans, ensure_schema
+from src.lexicon import load_lexicon
 
-logger = None
+logger = logging.getLogger(__name__)
 DB = "neo4j"
 
 
 class Editor:
-    def __init__(self):
+    """
+    Stopword removal and stemming of feature names. The same feature strings repeat across millions of tuples:
+    edited strings are kept in an LRU of `cache_size` entries, and stems of single words in a dictionary
+    that `save` writes to `stem_path` for later runs.
+    """
+
+    def __init__(self, cache_size=100000, stem_path=None):
         self.stemmer = PorterStemmer()
         self.stopwords = set(stopwords.words("english"))
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stem_path = stem_path
+        self.stems = read_pickle(stem_path) if stem_path and os.path.isfile(stem_path) else {}
+
+    def _stem(self, word):
+        stem = self.stems.get(word)
+        if stem is None:
+            stem = self.stems[word] = self.stemmer.stem(word)
+        return stem
 
     def edit(self, text):
+        if text in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(text)
+            return self.cache[text]
+        self.misses += 1
         words = word_tokenize(text)
         words = [w for w in words if w.lower() not in self.stopwords]
-        stemmed_words = [self.stemmer.stem(word) for word in words]
+        stemmed_words = [self._stem(word) for word in words]
         stemmed_text = " ".join(stemmed_words)
+        self.cache[text] = stemmed_text
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
         return stemmed_text
 
+    def edit_many(self, texts):
+        """Edit a batch of texts, each distinct one once"""
+        edited = {text: self.edit(text) for text in dict.fromkeys(texts)}
+        self.hits += len(texts) - len(edited)
+        return [edited[text] for text in texts]
 
-def get_driver(uri, username, password):
-    return GraphDatabase.driver(uri, auth=(username, password))
-
+    def save(self):
+        if self.stem_path:
+            write_pickle(self.stems, self.stem_path)
 
-def push_data(entity_id, entity_data, editor, driver, exp_name, dataset_name):
-    # Create entity and aspects
-    entity_params = {}
-    if dataset_name == "space":
-        entity_params = {
-            "entity_id": entity_id,
-            "exp_name": exp_name,
-            "aspects": [
-                {"id": f"{entity_id}_general", "name": "general"},
-                {"id": f"{entity_id}_rooms", "name": "rooms"},
-                {"id": f"{entity_id}_location", "name": "location"},
-                {"id": f"{entity_id}_service", "name": "service"},
-                {"id": f"{entity_id}_cleanliness", "name": "cleanliness"},
-                {"id": f"{entity_id}_building", "name": "building"},
-                {"id": f"{entity_id}_food", "name": "food"},
-            ],
+    def stats(self) -> dict:
+        n = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / n, 4) if n else 0.0,
+            "cached": len(self.cache),
+            "stems": len(self.stems),
         }
-    elif dataset_name == "amasum":
-        entity_params = {
-            "entity_id": entity_id,
-            "exp_name": exp_name,
-            "aspects": [
-                {"id": f"{entity_id}_general", "name": "general"},
+
+
+def get_driver(uri, username, password, **kwargs):
+    return GraphDatabase.driver(uri, auth=(username, password), **kwargs)
+
+
+# Cypher of a batch of entities, every row carries its entity_id so one UNWIND covers the whole batch
+CMD_CREATE_ENTITIES = """
+UNWIND $entities as ent
+MERGE (e:Entity {entity_id: ent.entity_id, exp_name: $exp_name})
+WITH e, ent
+UNWIND ent.aspects as aspect
+MERGE (e)-[:HAS_ASPECT]-(a:Aspect {entity_id: ent.entity_id, name: aspect.name, exp_name: $exp_name})
+"""
+# rows are aggregated by `build_entity_data`: one per (aspect, feature) with its count and its opinions,
+# each with all its descriptions, so every node and relationship is merged and written once
+CMD_CREATE_OTHER_DATA = """
+UNWIND $graph_data as fe
+MATCH (e:Entity {entity_id: fe.entity_id, exp_name: $exp_name})-[]-(a:Aspect {name: fe.aspect})
+MERGE (a)-[:HAS_FEATURE]->(f:Feature {entity_id: fe.entity_id, name: fe.feature, exp_name: $exp_name})
+SET f.count = fe.count
+WITH f, fe
+UNWIND fe.opinions as op
+MERGE (f)-[r:HAS_OPINION]->(o:Opinion {entity_id: fe.entity_id, name: op.name, exp_name: $exp_name})
+ON CREATE SET r.entity_id = fe.entity_id, r.exp_name = $exp_name
+WITH r, fe.aspect as aspect, op.descriptions as descriptions
+CALL apoc.create.setRelProperty(r, aspect, coalesce(r[aspect], []) + descriptions) YIELD rel
+RETURN count(rel)
+"""
+CMD_GET_PROCESSED_ENTITIES = """
+MATCH (e:Entity {exp_name: $exp_name})
+RETURN e.entity_id as entity_id
+"""
+# queries of the pipeline with parameters of the right shape, to check their plans
+PIPELINE_QUERIES = {
+    "create_entities": (CMD_CREATE_ENTITIES, {"entities": [{"entity_id": "", "aspects": [{"name": ""}]}], "exp_name": ""}),
+    "create_other_data": (
+        CMD_CREATE_OTHER_DATA,
+        {
+            "graph_data": [
+                {"entity_id": "", "aspect": "", "feature": "", "count": 0, "opinions": [{"name": "", "descriptions": [""]}]}
             ],
-        }
-    else:
-        raise ValueError()
+            "exp_name": "",
+        },
+    ),
+    "get_processed_entities": (CMD_GET_PROCESSED_ENTITIES, {"exp_name": ""}),
+}
+
+
+def build_entity_data(entity_id, entity_data, editor, dataset_name):
+    """
+    Rows of one entity for the batch statements: its aspects, and one row per (aspect, feature) with the
+    number of reviews mentioning the feature and its opinions, each with its descriptions in input order.
+    """
+    # Create entity and aspects
+    lexicon = load_lexicon(dataset_name)
+    entity_params = {
+        "entity_id": entity_id,
+        "aspects": [{"id": f"{entity_id}_{aspect}", "name": aspect} for aspect in lexicon.aspects],
+    }
+
+    # every distinct feature of the entity is edited once
+    features = [sentence_data["feature"] for review_data in entity_data.values() for sentence_data in review_data]
+    edited_features = dict(zip(features, editor.edit_many(features)))
 
     # add entity_data
-    graph_data = []
+    rows = {}
     review_count_by_feature = defaultdict(lambda: 0)
     for _, review_data in entity_data.items():
         reviewed_features = set()
         for sentence_data in review_data:
             aspect = sentence_data["aspect"]
-            feature = editor.edit(sentence_data["feature"])
+            # aspects without an Aspect node would be dropped by the MATCH below
+            if aspect not in lexicon.aspects:
+                aspect = lexicon.get_aspect(aspect if isinstance(aspect, str) else " ".join(aspect))
+            feature = edited_features[sentence_data["feature"]]
             # opinions = list(set([editor.edit(o) for o in sent['opinions']]))
             opinions = sentence_data["opinions"]
             opinions = [o for o in opinions if o != ""]
             description = sentence_data["description"]
 
-            for opinion in opinions:
-                graph_data.append(
-                    {
-                        "entity_id": entity_id,
-                        "aspect": aspect,
-                        "feature": feature,
-                        "opinion": opinion,
-                        "description": description,
-                    }
+            if opinions:
+                row = rows.setdefault(
+                    (aspect, feature), {"entity_id": entity_id, "aspect": aspect, "feature": feature, "opinions": {}}
                 )
+                for opinion in opinions:
+                    row["opinions"].setdefault(opinion, []).append(description)
 
             reviewed_features.add(feature)
         for feature in reviewed_features:
             review_count_by_feature[feature] += 1
 
-    # update review count on feature
-    feature_count_list = [{"feature": k, "count": v} for k, v in review_count_by_feature.items()]
+    # review count of a feature is set on its nodes of every aspect
+    graph_data = [
+        {
+            **row,
+            "count": review_count_by_feature[row["feature"]],
+            "opinions": [{"name": opinion, "descriptions": descriptions} for opinion, descriptions in row["opinions"].items()],
+        }
+        for row in rows.values()
+    ]
+    return entity_params, graph_data
 
-    # command
-    cmd_create_entity = """
-MERGE (e:Entity {entity_id: $entity_id, exp_name: $exp_name})
-WITH e
-UNWIND $aspects as aspect
-MERGE (e)-[:HAS_ASPECT]-(a:Aspect {entity_id: $entity_id, name: aspect.name, exp_name: $exp_name})
-"""
-#     cmd_create_entity = """
-# CALL apoc.periodic.iterate(
-#     "MERGE (e:Entity {entity_id: $entity_id, exp_name: $exp_name}) RETURN e",
-#     "UNWIND $aspects as aspect
-#     MERGE (e)-[:HAS_ASPECT]->(a:Aspect {entity_id: $entity_id, name: aspect.name, exp_name: $exp_name})",
-#     {batchSize: 1000, params: {aspects: $aspects, entity_id: $entity_id, exp_name: $exp_name}}
-# )
-#     """
-    cmd_create_other_data = """
-UNWIND $graph_data as fe
-MATCH (e:Entity {entity_id: fe.entity_id, exp_name: $exp_name})-[]-(a:Aspect {name: fe.aspect})
-MERGE (a)-[:HAS_FEATURE]->(f:Feature {entity_id: fe.entity_id, name: fe.feature, exp_name: $exp_name})
-MERGE (f)-[r:HAS_OPINION]->(o:Opinion {entity_id: fe.entity_id, name: fe.opinion, exp_name: $exp_name})
-ON CREATE SET r.entity_id = fe.entity_id, r.exp_name = $exp_name
-WITH r, fe.aspect as aspect, fe.description as description
-CALL apoc.create.setRelProperty(r, aspect, coalesce(r[aspect], []) + description) YIELD rel
-RETURN rel
-"""
-#     cmd_create_other_data = """
-# CALL apoc.periodic.iterate(
-#     "UNWIND $graph_data as fe RETURN fe",
-#     "MATCH (e:Entity {entity_id: fe.entity_id})-[:HAS_ASPECT]->(a:Aspect {name: fe.aspect, exp_name: $exp_name})
-#     MERGE (a)-[:HAS_FEATURE]->(f:Feature {name: fe.feature, exp_name: $exp_name})
-#     MERGE (f)-[:HAS_OPINION]->(o:Opinion {name: fe.opinion, exp_name: $exp_name})
-#     ON CREATE SET o.entity_id = fe.entity_id,
-#                     f.entity_id = fe.entity_id,
-#                     r.entity_id = fe.entity_id,
-#                     r.exp_name = $exp_name
-#     WITH r, fe.aspect as aspect, fe.description as description
-#     CALL apoc.create.setRelProperty(r, aspect, coalesce(r[aspect], []) + description) YIELD rel",
-#     {batchSize: 1000, params: {graph_data: $graph_data, exp_name: $exp_name}}
-# )
-#     """
-    cmd_set_feature_count = """
-UNWIND $feature_count as fc
-MATCH (e:Entity {entity_id: $entity_id, exp_name: $exp_name})-[]-(:Aspect)-[]-(f:Feature {name: fc.feature})
-SET f.count = fc.count
-"""
-#     cmd_set_feature_count = """
-# CALL apoc.periodic.iterate(
-#     "UNWIND $feature_count as fc RETURN fc",
-#     "MATCH (e:Entity {entity_id: $entity_id}, exp_name: $exp_name)-[:HAS_ASPECT]-(a:Aspect)-[:HAS_FEATURE]-(f:Feature {name: fc.feature, exp_name: $exp_name})
-#     SET f.count = fc.count",
-#     {batchSize: 1000, params: {feature_count: $feature_count, entity_id: $entity_id, exp_name: $exp_name}}
-# )
-# """
+
+def _write_batch_tx(tx, entities, graph_data, exp_name):
+    # consumed inside the function, so errors are raised where `execute_write` can retry them
+    tx.run(CMD_CREATE_ENTITIES, entities=entities, exp_name=exp_name).consume()
+    tx.run(CMD_CREATE_OTHER_DATA, graph_data=graph_data, exp_name=exp_name).consume()
+
+
+def write_batch(driver, batch, exp_name):
+    """
+    Write the `build_entity_data` rows of several entities in one managed transaction.
+    `execute_write` retries it with backoff on transient errors such as deadlocks, for up to the
+    driver's `max_transaction_retry_time`.
+    """
+    entities, graph_data = [], []
+    for entity_params, entity_graph_data in batch:
+        entities.append(entity_params)
+        graph_data.extend(entity_graph_data)
     with driver.session(database=DB) as session:
         try:
-            with session.begin_transaction() as tx:
-                tx.run(cmd_create_entity, **entity_params)
-                tx.run(cmd_create_other_data, **{"graph_data": graph_data, "exp_name": exp_name})
-                tx.run(
-                    cmd_set_feature_count,
-                    **{"feature_count": feature_count_list, "entity_id": entity_id, "exp_name": exp_name},
-                )
-
-                # Commit the transaction if everything is successful
-                tx.commit()
+            session.execute_write(_write_batch_tx, entities, graph_data, exp_name)
         except Exception as e:
-            logger.error(f"Transaction failed: {e}") 
-            logger.error(f"Failed entity_id: {entity_id}")
+            logger.error(f"Transaction failed: {e}")
+            logger.error(f"Failed entity_ids: {[entity['entity_id'] for entity in entities]}")
             raise e  # Optionally re-raise the exception for further handling
 
 
+def push_data(entity_id, entity_data, editor, driver, exp_name, dataset_name):
+    write_batch(driver, [build_entity_data(entity_id, entity_data, editor, dataset_name)], exp_name)
+
+
+class BatchWriter:
+    """
+    Accumulate entities and write `batch_size` of them per transaction, instead of one transaction and
+    two round trips per entity. With `num_workers` > 1, batches are written concurrently by a pool of
+    threads with a session each; entities never share nodes, so their transactions do not conflict
+    beyond the transient lock errors retried by `write_batch`.
+    Entities count as processed once their batch is committed, the Entity nodes are the resume record.
+    """
+
+    def __init__(
+        self, driver, exp_name, dataset_name, editor, batch_size=100, p_bar=None, num_workers=1
+    ) -> None:
+        self.driver = driver
+        self.exp_name = exp_name
+        self.dataset_name = dataset_name
+        self.editor = editor
+        self.batch_size = batch_size
+        self.p_bar = p_bar
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+        self.batch = []
+        self.pending = deque()
+
+    def add(self, entity_id, entity_data):
+        self.batch.append(build_entity_data(entity_id, entity_data, self.editor, self.dataset_name))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        if self.executor is None:
+            write_batch(self.driver, batch, self.exp_name)
+            self._done(batch)
+            return
+        self.pending.append((self.executor.submit(write_batch, self.driver, batch, self.exp_name), batch))
+        # a few batches per worker in flight, the reader must not buffer the whole input
+        while len(self.pending) > 2 * self.num_workers:
+            self._wait_one()
+
+    def _wait_one(self):
+        future, batch = self.pending.popleft()
+        future.result()
+        self._done(batch)
+
+    def _done(self, batch):
+        # the progress bar is only touched by the calling thread
+        if self.p_bar is not None:
+            self.p_bar.update(len(batch))
+
+    def close(self):
+        self.flush()
+        while self.pending:
+            self._wait_one()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class CSVExporter:
+    """
+    Write the graph `push_data` would build as CSV files for `neo4j-admin database import`, the offline
+    importer being much faster than MERGE for the first load of an `exp_name`. Rows come from
+    `build_entity_data` and nodes follow the MERGE patterns: a Feature node per (aspect, name), an Opinion
+    node per (feature node, name), descriptions listed on HAS_OPINION under the aspect name.
+    IDs are integers numbered in input order, the same input always gives the same files.
+    """
+
+    ARRAY_DELIMITER = "\x1f"
+
+    def __init__(self, output_dir, exp_name, dataset_name, editor) -> None:
+        self.output_dir = output_dir
+        self.exp_name = exp_name
+        self.dataset_name = dataset_name
+        self.editor = editor
+        self.aspects = load_lexicon(dataset_name).aspects
+        self.n_nodes = defaultdict(int)
+        os.makedirs(output_dir, exist_ok=True)
+        self.files = {}
+        self.writers = {}
+        self.entity_id_type = None
+
+    def _writer(self, name, header):
+        if name not in self.writers:
+            self.files[name] = open(os.path.join(self.output_dir, f"{name}.csv"), "w", newline="")
+            self.writers[name] = csv.writer(self.files[name])
+            self.writers[name].writerow(header)
+        return self.writers[name]
+
+    def _node(self, label, properties, header):
+        node_id = self.n_nodes[label]
+        self.n_nodes[label] += 1
+        self._writer(label, [f":ID({label})", *header, ":LABEL"]).writerow([node_id, *properties, label])
+        return node_id
+
+    def add(self, entity_id, entity_data):
+        entity_params, graph_data = build_entity_data(entity_id, entity_data, self.editor, self.dataset_name)
+        if self.entity_id_type is None:
+            self.entity_id_type = "entity_id:long" if isinstance(entity_id, int) else "entity_id"
+        header = [self.entity_id_type, "exp_name"]
+        named_header = [self.entity_id_type, "name", "exp_name"]
+
+        entity_node = self._node("Entity", [entity_id, self.exp_name], header)
+        aspect_nodes = {}
+        for aspect in entity_params["aspects"]:
+            aspect_nodes[aspect["name"]] = self._node("Aspect", [entity_id, aspect["name"], self.exp_name], named_header)
+            self._writer("HAS_ASPECT", [":START_ID(Entity)", ":END_ID(Aspect)", ":TYPE"]).writerow(
+                [entity_node, aspect_nodes[aspect["name"]], "HAS_ASPECT"]
+            )
+
+        # rows are already one per Feature node, with one entry per Opinion node
+        for fe in graph_data:
+            # rows of unknown aspects are dropped by the MATCH of `push_data`
+            if fe["aspect"] not in aspect_nodes:
+                continue
+            feature_node = self._node(
+                "Feature", [entity_id, fe["feature"], self.exp_name, fe["count"]], [*named_header, "count:long"]
+            )
+            self._writer("HAS_FEATURE", [":START_ID(Aspect)", ":END_ID(Feature)", ":TYPE"]).writerow(
+                [aspect_nodes[fe["aspect"]], feature_node, "HAS_FEATURE"]
+            )
+            # one relationship file per aspect, each with the description list property of its aspect only
+            header = [":START_ID(Feature)", ":END_ID(Opinion)", self.entity_id_type, "exp_name", f"{fe['aspect']}:string[]", ":TYPE"]
+            for op in fe["opinions"]:
+                opinion_node = self._node("Opinion", [entity_id, op["name"], self.exp_name], named_header)
+                descriptions = [d.replace(self.ARRAY_DELIMITER, " ") for d in op["descriptions"]]
+                self._writer(f"HAS_OPINION_{fe['aspect']}", header).writerow(
+                    [feature_node, opinion_node, entity_id, self.exp_name, self.ARRAY_DELIMITER.join(descriptions), "HAS_OPINION"]
+                )
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        logger.info(f"Exported {dict(self.n_nodes)} nodes to `{self.output_dir}`")
+        logger.info(f"Import them into an empty database with:\n{self.import_command()}")
+
+    def import_command(self, database=DB):
+        paths = {name: os.path.join(self.output_dir, f"{name}.csv") for name in self.files}
+        nodes = [f"--nodes={path}" for name, path in paths.items() if not name.startswith("HAS_")]
+        relationships = [f"--relationships={path}" for name, path in paths.items() if name.startswith("HAS_")]
+        return " ".join(
+            [
+                "neo4j-admin database import full",
+                *nodes,
+                *relationships,
+                "--id-type=INTEGER",
+                "--array-delimiter=U+001F",
+                "--multiline-fields=true",
+                database,
+            ]
+        )
+
+
 def get_processed_entities(exp_name, driver):
     """
     Query the database to get the list of entity_ids that are already in the database
     """
-    cmd = """
-MATCH (e:Entity {exp_name: $exp_name})
-RETURN e.entity_id as entity_id
-"""
-    result, _, _ = driver.execute_query(cmd, parameters_={"exp_name": exp_name}, database_=DB)
-    return [r['entity_id'] for r in result]
+    result, _, _ = driver.execute_query(CMD_GET_PROCESSED_ENTITIES, parameters_={"exp_name": exp_name}, database_=DB)
+    return set(r['entity_id'] for r in result)
+
+
+def group_by_entity(parsed_reviews):
+    """
+    Group consecutive parsed reviews into (entity_id, {review_id: sentence_data}) without reading ahead,
+    so memory depends on the largest entity. The input must be ordered by entity.
+    """
+    finished = set()
+    entity_id, entity_data = None, {}
+    for d in parsed_reviews:
+        if d["entity_id"] != entity_id:
+            if entity_id is not None:
+                yield entity_id, entity_data
+                finished.add(entity_id)
+            if d["entity_id"] in finished:
+                raise ValueError(f"Entity {d['entity_id']} is not contiguous in the input, run without streaming")
+            entity_id, entity_data = d["entity_id"], {}
+        entity_data.setdefault(d["review_id"], []).extend(d["data"])
+    if entity_id is not None:
+        yield entity_id, entity_data
 
 
 def main():
@@ -180,6 +398,20 @@ def main():
     parser.add_argument("--input_path", type=str, default=None)
     parser.add_argument("--dataset", type=str, default="amasum")
     parser.add_argument("--exp_name", type=str, default="amasum_mistral")
+    parser.add_argument("--stream", action="store_true", default=False, help="Read one entity at a time, input ordered by entity")
+    parser.add_argument("--batch_size", type=int, default=100, help="Entities written per transaction")
+    parser.add_argument(
+        "--export_dir", type=str, default=None, help="Write CSVs for `neo4j-admin database import` instead of pushing"
+    )
+    parser.add_argument(
+        "--check_plans", type=str, default="warn", choices=["off", "warn", "fail"], help="On label scans in query plans"
+    )
+    parser.add_argument("--editor_cache_size", type=int, default=100000, help="Edited feature names kept in memory")
+    parser.add_argument("--stem_path", type=str, default=None, help="Pickled word stems reused across runs, None to disable")
+    parser.add_argument("--num_writers", type=int, default=1, help="Batches written concurrently, each by its own session")
+    parser.add_argument(
+        "--max_retry_time", type=float, default=30.0, help="Seconds a batch is retried on transient errors, e.g. deadlocks"
+    )
     args = parser.parse_args()
     cfg.update(args)
 
@@ -190,19 +422,45 @@ def main():
     # logger.info(f"Config:\n{cfg}")
 
     # Parse the input data
-    parsed_data = read_jsonl(cfg.CONF["input_path"])
-    entities = OrderedDict()
-    for d in parsed_data:
-        entity_id = d["entity_id"]
-        review_id = d["review_id"]
-        if entity_id not in entities:
-            entities[entity_id] = {}
-        if review_id not in entities[entity_id]:
-            entities[entity_id][review_id] = []
-        entities[entity_id][review_id] += d["data"]
+    if cfg.CONF["stream"]:
+        entities = group_by_entity(iter_jsonl(cfg.CONF["input_path"]))
+    else:
+        parsed_data = read_jsonl(cfg.CONF["input_path"])
+        entities = OrderedDict()
+        for d in parsed_data:
+            entity_id = d["entity_id"]
+            review_id = d["review_id"]
+            if entity_id not in entities:
+                entities[entity_id] = {}
+            if review_id not in entities[entity_id]:
+                entities[entity_id][review_id] = []
+            entities[entity_id][review_id] += d["data"]
+
+    editor = Editor(cache_size=cfg.CONF["editor_cache_size"], stem_path=cfg.CONF["stem_path"])
+    if cfg.CONF["export_dir"]:
+        # first load of an exp_name into an empty database, there is nothing to skip
+        if not cfg.CONF["stream"]:
+            entities = entities.items()
+        exporter = CSVExporter(cfg.CONF["export_dir"], cfg.CONF["exp_name"], cfg.CONF["dataset"], editor)
+        for entity_id, entity_data in tqdm(entities, desc="Exporting entities", ncols=0):
+            exporter.add(entity_id, entity_data)
+        exporter.close()
+        editor.save()
+        logger.info(f"Feature editor: {editor.stats()}")
+        return
 
     # Connect to the database
-    driver = get_driver(**cfg.DB_CONF["neo4j"])
+    driver = get_driver(
+        **cfg.DB_CONF["neo4j"],
+        max_transaction_retry_time=cfg.CONF["max_retry_time"],
+        # one connection per writer, plus the reads of the main thread
+        max_connection_pool_size=max(cfg.CONF["num_writers"] + 1, 100),
+    )
+
+    # Indexes first, every query below seeks through them
+    ensure_schema(driver, DB)
+    if cfg.CONF["check_plans"] != "off":
+        check_query_plans(driver, PIPELINE_QUERIES, DB, strict=cfg.CONF["check_plans"] == "fail")
 
     # Get list of entity_ids that are already in the database
     processed_entities = get_processed_entities(cfg.CONF["exp_name"], driver)
@@ -210,17 +468,30 @@ def main():
     logger.info(f"Found {len(processed_entities)} entities in the database.")
 
     # Remove already processed entities
-    entities = {k: v for k, v in entities.items() if k not in processed_entities}
-
-    editor = Editor()
-    p_bar = tqdm(total=len(entities), desc="Processing entities", ncols=0)
-    for entity_id, entity_data in entities.items():
-        # logger.info(f"Processing entity: {entity_id}")
-        push_data(
-            entity_id, entity_data, editor, driver, exp_name=cfg.CONF["exp_name"], dataset_name=cfg.CONF["dataset"]
-        )
-        p_bar.update(1)
+    n_entities = None
+    if not cfg.CONF["stream"]:
+        entities = {k: v for k, v in entities.items() if k not in processed_entities}
+        n_entities = len(entities)
+        entities = entities.items()
+
+    p_bar = tqdm(total=n_entities, desc="Processing entities", ncols=0)
+    writer = BatchWriter(
+        driver,
+        cfg.CONF["exp_name"],
+        cfg.CONF["dataset"],
+        editor,
+        batch_size=cfg.CONF["batch_size"],
+        p_bar=p_bar,
+        num_workers=cfg.CONF["num_writers"],
+    )
+    for entity_id, entity_data in entities:
+        if entity_id in processed_entities:
+            continue
+        writer.add(entity_id, entity_data)
+    writer.close()
     p_bar.close()
+    editor.save()
+    logger.info(f"Feature editor: {editor.stats()}")
     driver.close()  # Dont forget to close driver
 
 
@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import logging
+import os
+from collections import Counter
+from tqdm import tqdm
+from src import prompt_template
+from src.config import cfg
+from src.data_utils import read_reviews
+from src.extract import generate_async, get_messages, load_journal, write_output
+from src.parse import get_response_parser, iter_parsed_reviews, parse_review
+from src.utils import iter_jsonl, setup_logger, write_jsonl
+
+logger = logging.getLogger(__name__)
+
+# why an extraction is re-asked: a blank response (failed request), text with no tuple in it,
+# only invalid tuples, or with `--repair_partial` some invalid tuples next to valid ones
+REASONS = ["empty", "no_tuples", "invalid", "partial"]
+
+
+def get_failure_reason(review, parser):
+    """Reason to re-ask the extraction of `review`, None when it parsed well"""
+    if not review["response"].strip():
+        return "empty"
+    obj, cnt_invalid = parse_review(review, parser)
+    if not obj["data"]:
+        return "invalid" if cnt_invalid > 0 else "no_tuples"
+    return "partial" if cnt_invalid > 0 else None
+
+
+def find_failures(input_path, dataset_name, reasons):
+    """
+    Return {(entity_id, review_id): reason} of the raw extraction outputs to re-ask.
+    Prefiltered reviews were never generated on purpose, and near-duplicates are copies of the
+    output of their representative, which is re-asked instead.
+    """
+    parser = get_response_parser(dataset_name)
+    failures = {}
+    for review in iter_jsonl(input_path):
+        if review.get("prefiltered") or review.get("duplicate_of"):
+            continue
+        reason = get_failure_reason(review, parser)
+        if reason in reasons:
+            failures[(review["entity_id"], review["review_id"])] = reason
+    return failures
+
+
+def is_better(new_response, old_response, parser):
+    """A repaired response replaces the original only if it has more valid tuples, or as many and fewer invalid"""
+    new_obj, new_invalid = parse_review({"entity_id": None, "review_id": None, "response": new_response}, parser)
+    old_obj, old_invalid = parse_review({"entity_id": None, "review_id": None, "response": old_response}, parser)
+    return (len(new_obj["data"]), -new_invalid) > (len(old_obj["data"]), -old_invalid)
+
+
+def merge_repairs(input_path, repair_path, dataset_name, output_path):
+    """
+    Parse the raw extraction outputs with their improved repairs substituted, in input order, so the result
+    replaces the parsed file of `parse.py`. Near-duplicates take the repair of their representative.
+    """
+    parser = get_response_parser(dataset_name)
+    repairs = {}
+    if os.path.isfile(repair_path):
+        repairs = {(r["entity_id"], r["review_id"]): r["response"] for r in iter_jsonl(repair_path)}
+    originals = {}
+    for review in iter_jsonl(input_path):
+        key = (review["entity_id"], review["review_id"])
+        if key in repairs:
+            originals[key] = review["response"]
+    improved = {key: repairs[key] for key, response in originals.items() if is_better(repairs[key], response, parser)}
+    logger.info(f"{len(improved)}/{len(repairs)} repaired extractions are better than the original")
+
+    def iter_reviews():
+        for review in iter_jsonl(input_path):
+            source = review.get("duplicate_of") or {"entity_id": review["entity_id"], "review_id": review["review_id"]}
+            key = (source["entity_id"], source["review_id"])
+            if key in improved:
+                review = {**review, "response": improved[key]}
+            yield review
+
+    stats = {}
+    write_jsonl(iter_parsed_reviews(iter_reviews(), dataset_name, stats=stats), output_path, verbose=False)
+    logger.info(f"Discarded {stats['cnt_invalid']} invalid sentences")
+    logger.info(f"Found {stats['cnt_empty']} parsed reviews with no valid sentences")
+    logger.info(f"Saved merged parsed reviews to `{output_path}`")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-ask only the extractions that failed to parse, then merge them back.")
+    parser.add_argument(
+        "--log_level", type=str, default="INFO", help="Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)"
+    )
+    parser.add_argument("--log_file", type=str, default=None)
+    parser.add_argument("--dataset", type=str, default="amasum")
+    parser.add_argument("--model_name", type=str, default="mistral")
+    parser.add_argument("--input_path", type=str, default=None, help="Raw extraction output of `extract.py`")
+    parser.add_argument("--output_path", type=str, default=None, help="Merged parsed reviews, as written by `parse.py`")
+    parser.add_argument("--repair_path", type=str, default=None, help="Raw repaired outputs, default `<input_path>.repair`")
+    parser.add_argument("--repair_partial", action="store_true", default=False, help="Also re-ask reviews with some invalid tuples")
+    parser.add_argument("--temperature", type=float, default=None, help="Sampling temperature of the repair, default the extraction one")
+    parser.add_argument("--async_mode", action="store_true", default=False, help="Send concurrent requests to GPT")
+    parser.add_argument("--concurrency", type=int, default=16, help="Max in-flight requests in async mode")
+    parser.add_argument("--requests_per_minute", type=float, default=0, help="Rate limit in async mode, 0 to disable")
+    args = parser.parse_args()
+    cfg.update(args)
+
+    global logger
+    logger = setup_logger(file=args.log_file, level=args.log_level)
+
+    dataset_name = cfg.CONF["dataset"]
+    input_path = cfg.CONF["input_path"]
+    repair_path = cfg.CONF["repair_path"] or f"{input_path}.repair"
+    reasons = REASONS if cfg.CONF["repair_partial"] else REASONS[:-1]
+
+    failures = find_failures(input_path, dataset_name, reasons)
+    logger.info(f"Found {len(failures)} failed extractions: {dict(Counter(failures.values()))}")
+
+    journal = load_journal(f"{repair_path}.journal", repair_path)
+    reviews = read_reviews(path=cfg.DATA_CONF[dataset_name]["test_path"], dataset_name=dataset_name)
+    reviews = [
+        r
+        for r in reviews
+        if (r["entity_id"], r["review_id"]) in failures and (r["entity_id"], r["review_id"], None) not in journal
+    ]
+    logger.info(f"Remaining {len(reviews)} reviews to repair")
+
+    # the stricter prompt also keeps the repair out of the response cache of the first run
+    messages_list = get_messages(reviews, prompt_template.PROMPT_EXTRACTION_REPAIR[dataset_name].strip())
+    extraction_conf = cfg.CONF["extraction"]
+    temperature = extraction_conf["temperature"] if cfg.CONF["temperature"] is None else cfg.CONF["temperature"]
+
+    p_bar = tqdm(total=len(reviews), desc="Repairing", ncols=0)
+    if "gpt" in cfg.CONF["model_name"]:
+        from src.call_llm.gpt import GPT
+
+        model = GPT(**cfg.OPENAI_CONF[cfg.CONF["model_name"]])
+        sampling_params = {
+            "max_tokens": extraction_conf["max_tokens"],
+            "temperature": temperature,
+            "top_p": extraction_conf["top_p"],
+        }
+        groups = [[r] for r in reviews]
+        if cfg.CONF["async_mode"]:
+            asyncio.run(
+                generate_async(
+                    model,
+                    groups,
+                    messages_list,
+                    sampling_params,
+                    repair_path,
+                    concurrency=cfg.CONF["concurrency"],
+                    requests_per_minute=cfg.CONF["requests_per_minute"],
+                    p_bar=p_bar,
+                    journal=journal,
+                )
+            )
+        else:
+            for review, messages in zip(reviews, messages_list):
+                response = model.generate(messages, sampling_params)
+                write_output([review], [response], repair_path, journal=journal, verbose=False)
+                p_bar.update(1)
+        logger.info(f"GPT request stats: {model.get_stats()}")
+    else:
+        from vllm import SamplingParams
+        from src.call_llm.vllm_model import VLLMModel
+
+        sampling_params = SamplingParams(
+            max_tokens=extraction_conf["max_tokens"],
+            temperature=temperature,
+            top_p=extraction_conf["top_p"],
+            top_k=extraction_conf["top_k"],
+        )
+        model_config = cfg.HF_CONF["mistral"]
+        model = VLLMModel(
+            model_config["model_path"], swap_space=4, dtype=model_config["dtype"], seed=42, gpu_memory_utilization=0.9
+        )
+        batch_size = cfg.CONF["vllm_batch_size"]
+        for i in range(0, len(reviews), batch_size):
+            responses = model.batch_generate(messages_list[i : i + batch_size], sampling_params=sampling_params)
+            write_output(reviews[i : i + batch_size], [r.strip() for r in responses], repair_path, journal=journal)
+            p_bar.update(len(responses))
+    p_bar.close()
+    journal.close()
+
+    merge_repairs(input_path, repair_path, dataset_name, cfg.CONF["output_path"])
+
+
+if __name__ == "__main__":
+    main()
@@ -62,13 +62,21 @@ def read_jsonl(path: str, n: int = 0) -> list[dict]:
     logger.info(f"Read {len(data)} lines from `{path}`")
     return data
 
-def read_jsonl_chunk(path: str, chunk_size=10000, n: int = 0) -> Generator[list[dict], Any, Any]:
+def iter_jsonl(path: str) -> Generator[dict, Any, Any]:
+    """Yield one object per line without loading the whole file"""
+    with open(path) as f:
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
+
+def read_jsonl_chunk(path: str, chunk_size=10000, n: int = 0, decode: bool = True) -> Generator[list, Any, Any]:
+    """Yield lists of `chunk_size` objects, or of raw lines with `decode=False` to decode them in worker processes"""
     data = []
     cnt = 0
     with open(path) as f:
         for line in tqdm(f, desc=path, ncols=0):
             if line.strip() != "":
-                data.append(json.loads(line.strip()))
+                data.append(json.loads(line.strip()) if decode else line.strip())
                 cnt += 1
                 if n > 0 and cnt >= n:
                     break
@@ -1,6 +1,7 @@
 import pickle
 import torch
 from src.utils import read_jsonl, write_jsonl, setup_logger
+from src.call_llm.cache import ResponseCache
 from vllm import LLM, SamplingParams
 
 ASPECTS = ["building", "cleanliness", "food", "location", "rooms", "service"]
@@ -43,10 +44,18 @@ class Graph():
                 texts = data['texts'][0]
                 yield feature, opinion, texts
 
-def summ(model, prompt, max_tokens=128, temperature=1.0, top_p=0.9, top_k=50):
+def summ(model, prompt, max_tokens=128, temperature=1.0, top_p=0.9, top_k=50, cache=None, model_name=""):
     params = SamplingParams(max_tokens=max_tokens, temperature=temperature, top_p=top_p, top_k=top_k) 
+    if cache is not None:
+        key = cache.make_key(model_name, prompt, params)
+        response = cache.get(key)
+        if response is not None:
+            return response
     output = model.generate(prompt, sampling_params=params)
-    return output[0].outputs[0].text.strip()
+    response = output[0].outputs[0].text.strip()
+    if cache is not None:
+        cache.set(key, response)
+    return response
 
 if __name__ == "__main__":
     feature_embeddings = pickle.load(open('output/wiki/feature_embeddings.pkl', 'rb'))
@@ -57,6 +66,7 @@ if __name__ == "__main__":
 
     model_path = '/lustre/scratch/client/vinai/users/hoangnv49/hf/mistralai/Mistral-7B-Instruct-v0.2'
     model = LLM(model_path)
+    cache = ResponseCache('output/wiki/llm_cache.sqlite')
 
     output = []
     for entity in feature_embeddings:
@@ -79,13 +89,14 @@ if __name__ == "__main__":
                 general_reviews.append(f"{feature} {opinion} {text}")
             prompt = " ".join(reviews)
             prompt = f"Briefly summarize the following reviews for aspect {aspect}:\n{prompt}"
-            summary = summ(model, prompt)
+            summary = summ(model, prompt, cache=cache, model_name=model_path)
             output.append({"entity_id": entity_id, "aspect": aspect, "summaries": [summary]})
 
         # general aspect
         prompt = " ".join(general_reviews)
         prompt = f"Briefly summarize the following reviews:\n{prompt}"
-        summary = summ(model, prompt, max_tokens=256)
+        summary = summ(model, prompt, max_tokens=256, cache=cache, model_name=model_path)
         output.append({"entity_id": entity_id, "aspect": "general", "summaries": [summary]})
 
+    cache.close()
     write_jsonl(output, 'output/wiki/summ.jsonl')
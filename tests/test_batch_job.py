@@ -0,0 +1,131 @@
+import json
+import os
+from types import SimpleNamespace
+from src.call_llm.batch_job import BatchJob
+
+
+class FakeFiles:
+    def __init__(self) -> None:
+        self.contents = {}
+
+    def create(self, file, purpose):
+        file_id = f"file-{len(self.contents)}"
+        self.contents[file_id] = file.read().decode("utf-8")
+        return SimpleNamespace(id=file_id)
+
+    def content(self, file_id):
+        return SimpleNamespace(text=self.contents[file_id])
+
+
+class FakeBatches:
+    """Batch endpoint answering every request with its custom_id, except the `failing` ones"""
+
+    def __init__(self, files) -> None:
+        self.files = files
+        self.batches = {}
+        self.failing = set()
+
+    def create(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch-{len(self.batches)}"
+        self.batches[batch_id] = SimpleNamespace(
+            id=batch_id, input_file_id=input_file_id, status="in_progress", output_file_id=None, request_counts={}
+        )
+        return self.batches[batch_id]
+
+    def complete(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = []
+        for line in self.files.contents[batch.input_file_id].splitlines():
+            custom_id = json.loads(line)["custom_id"]
+            if custom_id in self.failing:
+                lines.append({"custom_id": custom_id, "response": {"status_code": 500, "body": {}}, "error": None})
+            else:
+                body = {"choices": [{"message": {"content": f" answer {custom_id} "}}]}
+                lines.append({"custom_id": custom_id, "response": {"status_code": 200, "body": body}, "error": None})
+        content = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+        output = self.files.create(SimpleNamespace(read=lambda: content), "batch_output")
+        batch.output_file_id = output.id
+        batch.status = "completed"
+
+    def retrieve(self, batch_id):
+        return self.batches[batch_id]
+
+
+def make_gpt():
+    files = FakeFiles()
+    client = SimpleNamespace(files=files, batches=FakeBatches(files))
+    return SimpleNamespace(api_type="openai", model_name="m", client=client)
+
+
+def make_requests(n):
+    return [([1, i], [{"role": "user", "content": f"review {i}"}]) for i in range(n)]
+
+
+def complete_all(gpt):
+    for batch_id, batch in gpt.client.batches.batches.items():
+        if batch.status != "completed":
+            gpt.client.batches.complete(batch_id)
+
+
+def test_batch_job_full_run(tmp_path):
+    gpt = make_gpt()
+    job = BatchJob(gpt, str(tmp_path), max_requests=2, poll_interval=0)
+    assert len(job.prepare(make_requests(5), {"max_tokens": 8})) == 3
+    job.submit()
+    complete_all(gpt)
+    job.wait()
+    results = dict((tuple(key), response) for key, response in job.iter_results())
+    assert results == {(1, i): f"answer [1, {i}]" for i in range(5)}
+    job.cleanup()
+    assert os.listdir(tmp_path) == []
+
+
+def test_batch_job_ingest_after_interrupted_run(tmp_path):
+    gpt = make_gpt()
+    job = BatchJob(gpt, str(tmp_path), max_requests=2, poll_interval=0)
+    job.prepare(make_requests(5), {})
+    job.submit()
+
+    # `--batch_stage ingest` while the batches still run remotely
+    job = BatchJob(gpt, str(tmp_path), max_requests=2, poll_interval=0)
+    job.prepare(make_requests(5), {})
+    assert list(job.iter_results()) == []
+    job.cleanup()
+    state = json.loads((tmp_path / "state.json").read_text())
+    assert sorted(state.values()) == ["batch-0", "batch-1", "batch-2"]
+
+    # a later `run` polls the same batches instead of submitting new ones
+    job = BatchJob(gpt, str(tmp_path), max_requests=2, poll_interval=0)
+    job.prepare(make_requests(5), {})
+    job.submit()
+    assert len(gpt.client.batches.batches) == 3
+    complete_all(gpt)
+    job.wait()
+    assert sorted(key[1] for key, _ in job.iter_results()) == [0, 1, 2, 3, 4]
+    job.cleanup()
+    assert os.listdir(tmp_path) == []
+
+
+def test_batch_job_rewrites_failed_requests(tmp_path):
+    gpt = make_gpt()
+    gpt.client.batches.failing = {json.dumps([1, 1])}
+    job = BatchJob(gpt, str(tmp_path), max_requests=2, poll_interval=0)
+    job.prepare(make_requests(3), {})
+    job.submit()
+    complete_all(gpt)
+    job.wait()
+    assert sorted(key[1] for key, _ in job.iter_results()) == [0, 2]
+    job.cleanup()
+    assert os.listdir(tmp_path) == []
+
+    # the next run is given the requests not ingested yet, only the failed one is written and submitted
+    gpt.client.batches.failing = set()
+    job = BatchJob(gpt, str(tmp_path), max_requests=2, poll_interval=0)
+    (path,) = job.prepare(make_requests(3)[1:2], {})
+    with open(path) as f:
+        assert [json.loads(line)["custom_id"] for line in f] == [json.dumps([1, 1])]
+    job.submit()
+    assert len(gpt.client.batches.batches) == 3
+    complete_all(gpt)
+    job.wait()
+    assert [key for key, _ in job.iter_results()] == [[1, 1]]
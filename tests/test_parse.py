@@ -0,0 +1,47 @@
+import re
+from src.parse import ExtractionStreamGuard, get_response_parser
+
+TUPLES = [
+    ("rooms", "bed", "comfortable", "The bed was comfortable."),
+    ("service", "staff", "friendly", "Friendly staff at the front desk."),
+    ("food", "breakfast", "tasty", "Tasty breakfast."),
+    ("location", "view", "great", "Great view of the sea."),
+    ("cleanliness", "bathroom", "spotless", "Spotless bathroom."),
+]
+
+
+def format_block(aspect, entity, opinion, description):
+    return f"#Aspect name: {aspect}\n#Entity name: {entity}\n#Expression phrases: {opinion}\n#Description: {description}"
+
+
+def tokenize(text):
+    # BPE-like chunks, labels such as `name:` end a chunk as they do in real streams
+    return re.findall(r"\s*[^\s:]+:?|\s+", text)
+
+
+def feed_all(guard, chunks):
+    for chunk in chunks:
+        if not guard.feed(chunk):
+            break
+    return guard
+
+
+def test_stream_guard_keeps_valid_response():
+    text = "\n".join(format_block(*t) for t in TUPLES)
+    chunks = tokenize(text)
+    assert "".join(chunks) == text
+    guard = feed_all(ExtractionStreamGuard("space"), chunks)
+    assert not guard.stopped
+    assert guard.result() == text
+    assert len(guard.starts) == len(TUPLES)
+
+
+def test_stream_guard_stops_repeated_block():
+    text = "\n".join(format_block(*t) for t in TUPLES[:3] + TUPLES[:1] * 5)
+    guard = feed_all(ExtractionStreamGuard("space"), tokenize(text))
+    assert guard.stopped
+    kept = guard.result()
+    assert kept == "\n".join(format_block(*t) for t in TUPLES[:3])
+    parser = get_response_parser("space")
+    blocks = ["#Aspect name:" + b for b in kept.split("#Aspect name:")[1:]]
+    assert [parser.parse_block(b.strip())["feature"] for b in blocks] == ["bed", "staff", "breakfast"]